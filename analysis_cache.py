@@ -0,0 +1,177 @@
+# ============================================================================
+# Name        : analysis_cache.py
+# Version     : 1.0.0
+# Description : Content-addressed cache of analyze() results. Entries are keyed
+#               by a hash of the analysis parameters, including the analysis
+#               version of data_postprocessing, and a hash of the input
+#               time, current and temperature columns. When the input extends a
+#               cached run (a run that is still being recorded), only the new
+#               windows are computed and appended to the cached ones. The least
+#               recently used entries are evicted above max_bytes. The index is
+#               changed under a file lock, so several processes can share a cache.
+# ============================================================================
+
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+import numpy as np
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+    import msvcrt
+
+def hash_params(params):
+    return hashlib.sha256(json.dumps(params, sort_keys = True).encode()).hexdigest()
+
+
+def hash_input(columns, n_rows = None):
+    # Hash of the first n_rows of each column, as float64
+    digest = hashlib.sha256()
+    for column in columns:
+        digest.update(np.ascontiguousarray(column[:n_rows], dtype = np.float64))
+    return digest.hexdigest()
+
+
+class AnalysisCache:
+    def __init__(self, directory = "../data/.analysis_cache", max_bytes = 500*2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, "index.json")
+        self.lock_path = os.path.join(directory, "index.lock")
+        self.hits = 0
+        self.extensions = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok = True)
+
+    def _load_index(self):
+        try:
+            with open(self.index_path) as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self, index):
+        # Written to a temporary file first, so a reader never sees half an index
+        temporary = "{}.{}.tmp".format(self.index_path, os.getpid())
+        with open(temporary, "w") as fd:
+            json.dump(index, fd, indent = 1)
+        os.replace(temporary, self.index_path)
+
+    def _read_rows(self, entry):
+        return np.load(os.path.join(self.directory, entry["file"]))
+
+    def _remove(self, index, key):
+        entry = index.pop(key)
+        try:
+            os.remove(os.path.join(self.directory, entry["file"]))
+        except OSError:
+            pass
+
+    def _evict(self, index, keep):
+        # Files that no entry references, e.g. left by a process that died while saving, are deleted first
+        referenced = {entry["file"] for entry in index.values()}
+        for name in os.listdir(self.directory):
+            if name.endswith(".npy") and name not in referenced:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+        total = sum(entry["size"] for entry in index.values())
+        for key in sorted(index, key = lambda key: index[key]["used"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= index[key]["size"]
+            self._remove(index, key)
+
+    @contextmanager
+    def _locked(self):
+        # Exclusive lock of the cache directory, held while the index is read, changed and
+        # written, so that processes sharing the cache do not overwrite each other's entries
+        with open(self.lock_path, "a+b") as fd:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            else:
+                fd.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(fd.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError: # LK_LOCK gives up after 10 s
+                        pass
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                else:
+                    fd.seek(0)
+                    msvcrt.locking(fd.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def get(self, columns, params, compute):
+        # Rows of the analysis of columns with params. compute(n_cached) must return the
+        # rows following the first n_cached rows of the analysis of columns. The lock is
+        # not held while compute() runs.
+        columns = [np.asarray(column, dtype = np.float64) for column in columns]
+        n_rows = len(columns[0])
+        params_hash = hash_params(params)
+        data_hash = hash_input(columns)
+        key = params_hash[:16] + data_hash[:32]
+        cached, prefix_key = None, None
+        with self._locked():
+            index = self._load_index()
+            if key in index:
+                try:
+                    rows = self._read_rows(index[key])
+                    self.hits += 1
+                    index[key]["used"] = time.time()
+                    self._save_index(index)
+                    return rows
+                except (OSError, ValueError):
+                    self._remove(index, key)
+            # Longest cached prefix of this input with the same parameters, read while locked
+            prefixes = sorted((entry["n_rows"], cached_key) for cached_key, entry in index.items()
+                              if entry["params_hash"] == params_hash and entry["n_rows"] < n_rows)
+            for n_prefix, cached_key in reversed(prefixes):
+                if hash_input(columns, n_prefix) != index[cached_key]["data_hash"]:
+                    continue
+                try:
+                    cached, prefix_key = self._read_rows(index[cached_key]), cached_key
+                    break
+                except (OSError, ValueError):
+                    continue
+            self._save_index(index)
+
+        if cached is not None:
+            rows = np.concatenate([cached, np.asarray(compute(len(cached)), dtype = np.float64)])
+            self.extensions += 1
+        else:
+            rows = np.asarray(compute(0), dtype = np.float64)
+            self.misses += 1
+
+        with self._locked():
+            # Reloaded, entries added by other processes in the meantime are kept
+            index = self._load_index()
+            if key not in index:
+                file_name = key + ".npy"
+                np.save(os.path.join(self.directory, file_name), rows)
+                index[key] = {"params": params,
+                              "params_hash": params_hash,
+                              "data_hash": data_hash,
+                              "n_rows": n_rows,
+                              "file": file_name,
+                              "size": int(rows.nbytes)}
+            if prefix_key is not None and prefix_key in index:
+                # The prefix is superseded by the extended run
+                self._remove(index, prefix_key)
+            index[key]["used"] = time.time()
+            self._evict(index, key)
+            self._save_index(index)
+        return rows
+
+    def report(self):
+        return "Analysis cache: {} hits, {} extensions, {} misses".format(self.hits, self.extensions, self.misses)
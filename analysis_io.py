@@ -0,0 +1,191 @@
+# ============================================================================
+# Name        : analysis_io.py
+# Version     : 1.0.0
+# Description : Columnar storage of analyzed data. Results are written as
+#               Parquet (row groups with time statistics) or Feather
+#               (uncompressed, memory-mapped), both through pyarrow, or in the
+#               native .run format when pyarrow is not installed. The loader
+#               reads a row range or a time range without loading the whole
+#               file. Excel is kept as a separate export.
+# ============================================================================
+
+import os
+import numpy as np
+import pandas as pd
+
+from run_format import BinaryRunWriter, RunReader
+
+ANALYSIS_EXTENSIONS = {"parquet": ".parquet", "feather": ".feather", "run": ".run", "csv": ".csv", "xlsx": ".xlsx"}
+ANALYSIS_UNITS = {"time": "s", "temperature": "degC", "current": "nA", "phase": "deg", "amplitude": "nA",
+                  "p_coeff": "uC/K/m2", "temp_amplitude": "K"}
+
+
+def has_pyarrow():
+    try:
+        import pyarrow
+        return True
+    except ImportError:
+        return False
+
+
+def resolve_format(output_format):
+    # Parquet and Feather need pyarrow, without it the native .run format is used
+    if output_format in ("parquet", "feather") and not has_pyarrow():
+        print("pyarrow is not installed, writing the .run format instead of {}".format(output_format))
+        return "run"
+    return output_format
+
+
+def analysis_path(file_name, output_format):
+    return file_name + ANALYSIS_EXTENSIONS[resolve_format(output_format)]
+
+
+def save_analysis(out, file_name, output_format = "parquet", row_group_size = 10000):
+    # Write out to file_name plus the extension of the format, returns the path written
+    output_format = resolve_format(output_format)
+    path = file_name + ANALYSIS_EXTENSIONS[output_format]
+    out = out.reset_index(drop = True)
+    if output_format == "parquet":
+        out.to_parquet(path, index = False, row_group_size = row_group_size)
+    elif output_format == "feather":
+        out.to_feather(path, compression = "uncompressed") # Uncompressed, so reads can be memory-mapped
+    elif output_format == "run":
+        if os.path.exists(path):
+            os.remove(path) # BinaryRunWriter appends to existing files
+        units = {name: ANALYSIS_UNITS.get(name, "") for name in out.columns}
+        with BinaryRunWriter(path, columns = list(out.columns), units = units, flush_rows = row_group_size,
+                             flush_interval = float("inf"), fsync = "close") as writer:
+            values = out.to_numpy(dtype = float)
+            for first in range(0, len(values), row_group_size):
+                writer.write_rows(values[first:first + row_group_size])
+    elif output_format == "csv":
+        out.to_csv(path, index = False)
+    elif output_format == "xlsx":
+        out.to_excel(path)
+    else:
+        raise ValueError("Unknown analysis format: {}".format(output_format))
+    return path
+
+
+class AnalysisWriter:
+    # Writes analyzed data block by block in the formats of save_analysis() except xlsx,
+    # so the whole table never has to be held in memory. Every block is a row group
+    # (Parquet), a record batch (Feather) or a chunk (.run).
+    def __init__(self, file_name, output_format = "parquet"):
+        self.output_format = resolve_format(output_format)
+        if self.output_format not in ("parquet", "feather", "run", "csv"):
+            raise ValueError("The {} format cannot be written block by block".format(self.output_format))
+        self.path = file_name + ANALYSIS_EXTENSIONS[self.output_format]
+        self.rows_written = 0
+        self._writer = None
+
+    def write(self, out):
+        out = out.reset_index(drop = True)
+        if self.output_format in ("parquet", "feather"):
+            import pyarrow as pa
+            table = pa.Table.from_pandas(out, preserve_index = False)
+            if self._writer is None:
+                if self.output_format == "parquet":
+                    import pyarrow.parquet as pq
+                    self._writer = pq.ParquetWriter(self.path, table.schema)
+                else:
+                    self._writer = pa.ipc.new_file(self.path, table.schema) # Feather is the Arrow IPC file format
+            self._writer.write_table(table)
+        elif self.output_format == "run":
+            if self._writer is None:
+                if os.path.exists(self.path):
+                    os.remove(self.path) # BinaryRunWriter appends to existing files
+                units = {name: ANALYSIS_UNITS.get(name, "") for name in out.columns}
+                self._writer = BinaryRunWriter(self.path, columns = list(out.columns), units = units,
+                                               flush_rows = float("inf"), flush_interval = float("inf"), fsync = "close")
+            self._writer.write_rows(out.to_numpy(dtype = float))
+            self._writer.flush()
+        else:
+            out.to_csv(self.path, index = False, header = self._writer is None, mode = "w" if self._writer is None else "a")
+            self._writer = True
+        self.rows_written += len(out)
+
+    def close(self):
+        if self._writer is not None and self._writer is not True:
+            self._writer.close()
+        return self.path
+
+
+def _slice_bounds(n_rows, rows):
+    start, stop = rows if rows is not None else (0, n_rows)
+    start = 0 if start is None else start
+    stop = n_rows if stop is None else min(stop, n_rows)
+    return start, max(start, stop)
+
+
+def load_analysis(path, rows = None, time_range = None, columns = None):
+    # rows = (start, stop) selects rows start ... stop-1 and keeps their row numbers as
+    # index, time_range = (start_time, stop_time) selects by the time column.
+    extension = os.path.splitext(path)[1]
+    if extension == ".parquet":
+        import pyarrow.parquet as pq
+        if time_range is not None:
+            # Row groups outside the range are skipped through their statistics
+            filters = [("time", ">=", time_range[0]), ("time", "<=", time_range[1])]
+            return pq.read_table(path, columns = columns, filters = filters).to_pandas()
+        parquet = pq.ParquetFile(path)
+        start, stop = _slice_bounds(parquet.metadata.num_rows, rows)
+        groups, first_row, offset = [], 0, None
+        for i in range(parquet.metadata.num_row_groups):
+            group_rows = parquet.metadata.row_group(i).num_rows
+            if first_row < stop and first_row + group_rows > start:
+                groups.append(i)
+                offset = first_row if offset is None else offset
+            first_row += group_rows
+        if not groups:
+            return pd.DataFrame(columns = columns or parquet.schema_arrow.names)
+        table = parquet.read_row_groups(groups, columns = columns)
+        out = table.slice(start - offset, stop - start).to_pandas()
+        out.index = pd.RangeIndex(start, stop)
+        return out
+    if extension == ".feather":
+        import pyarrow.feather as feather
+        table = feather.read_table(path, columns = columns, memory_map = True)
+        if time_range is not None:
+            time = table.column("time").to_numpy()
+            rows = (np.searchsorted(time, time_range[0], side = "left"), np.searchsorted(time, time_range[1], side = "right"))
+        start, stop = _slice_bounds(table.num_rows, rows)
+        out = table.slice(start, stop - start).to_pandas()
+        out.index = pd.RangeIndex(start, stop)
+        return out
+    if extension == ".run":
+        reader = RunReader(path)
+        try:
+            if time_range is not None:
+                return reader.time_range(time_range[0], time_range[1], columns).copy()
+            start, stop = _slice_bounds(reader.n_rows, rows)
+            return reader.rows(start, stop, columns).copy() # Copied, the file is unmapped below
+        finally:
+            reader.close()
+    if extension == ".csv" and time_range is None:
+        start, stop = _slice_bounds(float("inf"), rows)
+        out = pd.read_csv(path, usecols = columns, skiprows = range(1, start + 1),
+                          nrows = None if stop == float("inf") else stop - start)
+        out.index = pd.RangeIndex(start, start + len(out))
+        return out
+    # Excel, or CSV by time, has to be read completely
+    out = pd.read_excel(path, index_col = 0) if extension == ".xlsx" else pd.read_csv(path)
+    if columns is not None:
+        out = out[columns]
+    if time_range is not None:
+        return out[(out["time"] >= time_range[0]) & (out["time"] <= time_range[1])]
+    start, stop = _slice_bounds(len(out), rows)
+    return out.iloc[start:stop]
+
+
+def export_excel(path, excel_path = None):
+    # Convert an analysis file to Excel, e.g. for sharing, off the measurement path
+    excel_path = excel_path or os.path.splitext(path)[0] + ".xlsx"
+    load_analysis(path).to_excel(excel_path)
+    return excel_path
+
+
+if __name__ == "__main__":
+    import sys
+    for path in sys.argv[1:]:
+        print("Wrote " + export_excel(path))
@@ -0,0 +1,144 @@
+# ============================================================================
+# Name        : batch_reanalyze.py
+# Version     : 1.0.0
+# Description : Re-analyzes many recorded runs in parallel processes. Runs are
+#               given as files, globs or directories (searched recursively for
+#               .csv and .run files, side files such as _LIVE.csv are skipped).
+#               Runs whose REANALYZED output is newer than the run file are
+#               skipped unless --force is given, and one summary table with a
+#               line per run is written at the end.
+#               Example: python batch_reanalyze.py ../data --electrode-area 240e-6
+# ============================================================================
+
+import argparse
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import matplotlib
+matplotlib.use("Agg") # Figures are only saved
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+from data_postprocessing import analyze
+from run_format import load_run
+from analysis_cache import AnalysisCache
+from analysis_io import ANALYSIS_EXTENSIONS, analysis_path, save_analysis, load_analysis
+from plot_pyramid import save_pyramid
+
+# Files written next to the runs by the measurement and analysis scripts
+SIDE_SUFFIXES = ("ANALYZED", "SETUP", "_LIVE", "_LOCKIN", "LOCKIN", "_TIMING")
+
+
+def is_run_file(path):
+    stem, extension = os.path.splitext(os.path.basename(path))
+    return extension in (".csv", ".run") and not stem.endswith(SIDE_SUFFIXES)
+
+
+def find_runs(patterns):
+    runs = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for directory, _, files in os.walk(pattern):
+                runs += [os.path.join(directory, name) for name in files]
+        else:
+            runs += glob.glob(pattern, recursive = True)
+    return sorted(set(os.path.abspath(run) for run in runs if is_run_file(run)))
+
+
+def output_name(run_file):
+    return os.path.splitext(run_file)[0] + "REANALYZED"
+
+
+def is_done(run_file, output_format = "parquet"):
+    output = analysis_path(output_name(run_file), output_format)
+    return os.path.exists(output) and os.path.getmtime(output) >= os.path.getmtime(run_file)
+
+
+def summarize(run_file, analyzed_data, status, rows = None, duration = None, elapsed = None):
+    p_coeff = analyzed_data["p_coeff"] if analyzed_data is not None else pd.Series(dtype = float)
+    return {"run": run_file,
+            "status": status,
+            "rows": rows,
+            "duration_s": duration,
+            "points": len(p_coeff),
+            "p_coeff_mean": p_coeff.mean(),
+            "p_coeff_median": p_coeff.median(),
+            "p_coeff_std": p_coeff.std(),
+            "phase_mean": analyzed_data["phase"].mean() if analyzed_data is not None else np.nan,
+            "amplitude_mean": analyzed_data["amplitude"].mean() if analyzed_data is not None else np.nan,
+            "analysis_s": elapsed}
+
+
+def reanalyze_run(run_file, electrode_area, points_p_period, freq, window, engine, phase_method, decimation = "resample",
+                  output_format = "parquet", cache_directory = None):
+    start = time.perf_counter()
+    try:
+        df = load_run(run_file)
+        cache = AnalysisCache(cache_directory) if cache_directory is not None else None
+        analyzed_data, figure = analyze(df = df, electrode_area = electrode_area, points_p_period = points_p_period,
+                                        freq = freq, window = window, engine = engine, phase_method = phase_method,
+                                        decimation = decimation, cache = cache)
+        analysis_file = save_analysis(analyzed_data, output_name(run_file), output_format)
+        save_pyramid(df, run_file)
+        save_pyramid(analyzed_data, analysis_file)
+        figure.savefig(output_name(run_file) + ".png")
+        plt.close(figure)
+        return summarize(run_file, analyzed_data, "analyzed", len(df), df["time"].iloc[-1] - df["time"].iloc[0],
+                         round(time.perf_counter() - start, 3))
+    except Exception as e:
+        return summarize(run_file, None, "error: {}".format(e), elapsed = round(time.perf_counter() - start, 3))
+
+
+def summarize_done(run_file, output_format = "parquet"):
+    # Summary line of a run analyzed before, from its output
+    try:
+        return summarize(run_file, load_analysis(analysis_path(output_name(run_file), output_format)), "skipped")
+    except Exception as e:
+        return summarize(run_file, None, "skipped, output unreadable: {}".format(e))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Re-analyze many recorded runs in parallel.")
+    parser.add_argument("paths", nargs = "+", help = "Run files, globs or directories")
+    parser.add_argument("--electrode-area", type = float, default = 240e-6, help = "Electrode area in m2")
+    parser.add_argument("--points-p-period", type = int, default = 10)
+    parser.add_argument("--freq", type = float, default = 0.01, help = "Temperature frequency in Hz")
+    parser.add_argument("--window", type = int, default = 51, help = "Analysis window in points, odd")
+    parser.add_argument("--engine", choices = ["leastsq", "linear"], default = "linear")
+    parser.add_argument("--phase-method", choices = ["loop", "batched"], default = "batched")
+    parser.add_argument("--decimation", choices = ["stride", "resample"], default = "resample")
+    parser.add_argument("--workers", type = int, default = os.cpu_count())
+    parser.add_argument("--output-format", choices = list(ANALYSIS_EXTENSIONS), default = "parquet",
+                        help = "Format of the REANALYZED files")
+    parser.add_argument("--cache", help = "Analysis cache directory, e.g. ../data/.analysis_cache")
+    parser.add_argument("--force", action = "store_true", help = "Also re-analyze runs that are already done")
+    parser.add_argument("--summary", default = "batch_summary.csv", help = "Summary table (.csv or .xlsx)")
+    args = parser.parse_args()
+    assert args.window % 2 == 1, "The window must be odd"
+
+    runs = [run for run in find_runs(args.paths) if run != os.path.abspath(args.summary)]
+    todo = [run for run in runs if args.force or not is_done(run, args.output_format)]
+    print("{} runs found, {} to analyze".format(len(runs), len(todo)))
+    summary = [summarize_done(run, args.output_format) for run in runs if run not in todo]
+    with ProcessPoolExecutor(max_workers = args.workers) as pool:
+        futures = [pool.submit(reanalyze_run, run, args.electrode_area, args.points_p_period, args.freq,
+                               args.window, args.engine, args.phase_method, args.decimation, args.output_format,
+                               args.cache) for run in todo]
+        for n, future in enumerate(as_completed(futures), 1):
+            result = future.result()
+            summary.append(result)
+            print("[{}/{}] {}: {}".format(n, len(todo), result["run"], result["status"]))
+
+    table = pd.DataFrame(summary).sort_values("run")
+    if args.summary.endswith(".xlsx"):
+        table.to_excel(args.summary, index = False)
+    else:
+        table.to_csv(args.summary, index = False)
+    errors = sum(str(status).startswith("error") for status in table["status"])
+    print("Summary of {} runs written to {}, {} errors".format(len(table), args.summary, errors))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# ============================================================================
+# Name        : benchmark_acquisition.py
+# Version     : 1.0.0
+# Description : Runs the sharp_garn acquisition loop headless against the
+#               simulated instruments and reports samples per second, sample
+#               interval and per-call latency percentiles and the temperature
+#               control error.
+#               Example: python benchmark_acquisition.py --duration 60 --mode burst
+# ============================================================================
+
+import argparse
+import json
+import os
+import tempfile
+import numpy as np
+from simple_pid import PID
+
+from instrument_simulation import ThermalPlant, simulated_instruments
+from instrumentation import Instrumentation
+from run_writer import RunWriter
+from sharp_garn_method import acquisition_loop
+
+
+def run_benchmark(duration = 30, mode = "single", data_format = "ascii", time_scale = 1,
+                  keithley_latency = 0.0, cpx_latency = 0.005, coldplate_latency = 0.01,
+                  measure_time = 0.02, emulate_baud = True, burst_block_size = 100, burst_interval = 0.02,
+                  temp_ampl = 1, temp_freq = 0.01, temp_slope = 0.002, temp_offset = 25,
+                  P = 0.6, I = 0.03, D = 0.05, control_period = 0.1, seed = 0):
+    plant = ThermalPlant(ambient = temp_offset, time_scale = time_scale, seed = seed)
+    plant, k, cp, cpx, close = simulated_instruments(plant, keithley_latency = keithley_latency,
+                                                     cpx_latency = cpx_latency, coldplate_latency = coldplate_latency,
+                                                     measure_time = measure_time, emulate_baud = emulate_baud)
+    k.format_elements("tstamp, reading, vsource, etemperature")
+    k.format_data(data_format)
+    if data_format != "ascii":
+        k.format_border("swapped")
+    cpx.set_output(1)
+    cpx.set_current(4)
+    cp.set_tempTarget(temp_offset - 5)
+    cp.set_tempOn()
+    k.system_tstamp_relative_reset()
+
+    timing = Instrumentation()
+    timing.instrument_devices(k, cp, cpx)
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        writer = RunWriter(os.path.join(directory, "benchmark.csv"))
+        control = acquisition_loop(k, cp, cpx, writer, PID(P, I, D, setpoint = temp_offset, sample_time = 0.1),
+                                   loop_time = duration,
+                                   temp_freq = temp_freq,
+                                   temp_ampl = temp_ampl,
+                                   temp_slope = temp_slope,
+                                   temp_offset = temp_offset,
+                                   temp_margin = 5,
+                                   control_period = control_period,
+                                   acquisition_mode = mode,
+                                   burst_block_size = burst_block_size,
+                                   burst_interval = burst_interval,
+                                   timing = timing,
+                                   consumers = [rows.append],
+                                   verbose = False)
+        writer.close()
+    del k, cp, cpx # Let the drivers shut down while the backends still answer
+    close()
+
+    data = np.array(rows, dtype = float)
+    intervals = np.diff(data[:, 1])/time_scale*1000
+    # Control error over the last 80 % of the run, once the PID has settled
+    settled = data[len(data)//5:]
+    error = settled[:, 2] - settled[:, 4]
+    results = {"mode": mode,
+               "data_format": data_format,
+               "duration_s": duration,
+               "samples": len(data),
+               "samples_per_s": len(data)/duration,
+               "interval_ms": {"mean": float(intervals.mean()),
+                               "p50": float(np.percentile(intervals, 50)),
+                               "p90": float(np.percentile(intervals, 90)),
+                               "p99": float(np.percentile(intervals, 99))},
+               "control_error_K": {"rms": float(np.sqrt(np.mean(error**2))),
+                                   "max": float(np.abs(error).max())},
+               "control_jitter": control.scheduler.report(),
+               "calls": {}}
+    for name, histogram in timing.stats.items():
+        results["calls"][name] = {"n": histogram.n,
+                                  "mean_ms": histogram.total/histogram.n*1000 if histogram.n else 0,
+                                  "p50_ms": histogram.percentile(50)*1000,
+                                  "p99_ms": histogram.percentile(99)*1000,
+                                  "max_ms": histogram.max*1000,
+                                  "timeouts": histogram.timeouts,
+                                  "bytes_in": histogram.bytes_in}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark the acquisition loop on simulated instruments.")
+    parser.add_argument("--duration", type = float, default = 30, help = "Loop time in seconds")
+    parser.add_argument("--mode", choices = ["single", "burst"], default = "single")
+    parser.add_argument("--data-format", default = "ascii", help = "ascii, sreal or dreal")
+    parser.add_argument("--time-scale", type = float, default = 1, help = "Plant seconds per wall-clock second")
+    parser.add_argument("--keithley-latency", type = float, default = 0.0)
+    parser.add_argument("--cpx-latency", type = float, default = 0.005)
+    parser.add_argument("--coldplate-latency", type = float, default = 0.01)
+    parser.add_argument("--burst-interval", type = float, default = 0.02)
+    parser.add_argument("--no-baud", action = "store_true", help = "Do not emulate the 19200 baud transfer time")
+    parser.add_argument("--output", help = "Write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = run_benchmark(duration = args.duration, mode = args.mode, data_format = args.data_format,
+                            time_scale = args.time_scale, keithley_latency = args.keithley_latency,
+                            cpx_latency = args.cpx_latency, coldplate_latency = args.coldplate_latency,
+                            burst_interval = args.burst_interval, emulate_baud = not args.no_baud)
+    print("Samples per second: {:.2f}".format(results["samples_per_s"]))
+    print("Sample interval p50/p90/p99: {p50:.2f} / {p90:.2f} / {p99:.2f} ms".format(**results["interval_ms"]))
+    print("Control error rms: {rms:.4f} K  max: {max:.4f} K".format(**results["control_error_K"]))
+    print(results["control_jitter"])
+    for name in sorted(results["calls"]):
+        call = results["calls"][name]
+        print("{:<36} n: {:>7}  p50: {:>8.3f} ms  p99: {:>8.3f} ms  timeouts: {}".format(
+            name, call["n"], call["p50_ms"], call["p99_ms"], call["timeouts"]))
+    if args.output:
+        with open(args.output, "w") as fd:
+            json.dump(results, fd, indent = 2)
+
+
+if __name__ == "__main__":
+    main()
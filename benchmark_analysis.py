@@ -0,0 +1,179 @@
+# ============================================================================
+# Name        : benchmark_analysis.py
+# Version     : 1.0.0
+# Description : Accuracy and speed benchmark of the analysis. synthetic_run()
+#               generates runs with a known pyroelectric coefficient and phase,
+#               noise, temperature drift and irregular timestamps, and
+#               run_benchmark() analyzes them with every engine, recording the
+#               runtime, the peak traced memory and the p_coeff and phase
+#               errors. Results are written as JSON so that versions can be
+#               compared with --baseline.
+#               Example: python benchmark_analysis.py --durations 600 3600 --output analysis.json
+# ============================================================================
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+import matplotlib
+matplotlib.use("Agg") # Figures are only closed
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+from data_postprocessing import analyze
+from lockin import lockin_analyze
+from run_format import RUN_COLUMNS
+
+# Analysis configurations: analyze() keyword arguments, None for the lock-in analysis
+ENGINES = {"leastsq-loop-stride": {"engine": "leastsq", "phase_method": "loop", "decimation": "stride"},
+           "linear-loop-stride": {"engine": "linear", "phase_method": "loop", "decimation": "stride"},
+           "linear-batched-stride": {"engine": "linear", "phase_method": "batched", "decimation": "stride"},
+           "linear-batched-resample": {"engine": "linear", "phase_method": "batched", "decimation": "resample"},
+           "lockin": None}
+
+
+def synthetic_run(duration, p_coeff = 30e-6, phase = 90, electrode_area = 240e-6, freq = 0.01, temp_ampl = 1,
+                  temp_slope = 0.002, temp_offset = 25, sample_period = 0.1, jitter = 0.3, current_noise = 5e-12,
+                  temp_noise = 0.005, current_offset = 0, seed = 0):
+    # Run with the columns of a recording. In the conventions of analyze() the current lags the
+    # temperature by phase (deg) and its amplitude gives p_coeff (C/K/m2):
+    # current = p_coeff*area*2*pi*freq*temp_ampl/sin(phase)*sin(2*pi*freq*t - phase) + offset + noise.
+    # Sample intervals are sample_period*(1 +- jitter), uniformly distributed.
+    rng = np.random.default_rng(seed)
+    n = int(duration/sample_period) + 1
+    t = np.cumsum(sample_period*(1 + jitter*rng.uniform(-1, 1, n)))
+    t = t[t <= duration]
+    n = len(t)
+    wt = 2*np.pi*freq*t
+    target = temp_offset + temp_slope*t + temp_ampl*np.sin(wt)
+    current_ampl = p_coeff*electrode_area*2*np.pi*freq*temp_ampl/np.sin(np.radians(phase))
+    current = current_ampl*np.sin(wt - np.radians(phase)) + current_offset + rng.normal(0, current_noise, n)
+    ext_temp = target + rng.normal(0, temp_noise, n)
+    zeros = np.zeros(n)
+    return pd.DataFrame({"current": current, "time": t, "ext_temp": ext_temp, "int_temp": ext_temp,
+                         "new_target_temp": target, "pid_out_volt": zeros, "pelt_volt": zeros, "pelt_curr": zeros,
+                         "vsource": zeros}, columns = RUN_COLUMNS)
+
+
+def run_analysis(df, name, electrode_area, freq):
+    if ENGINES[name] is None:
+        return lockin_analyze(df, electrode_area = electrode_area, freq = freq)
+    out, figure = analyze(df, electrode_area = electrode_area, freq = freq, **ENGINES[name])
+    plt.close(figure)
+    return out
+
+
+def errors(out, p_coeff, phase):
+    # p_coeff errors in uC/K/m2 and phase errors in deg of the analyzed rows, None without rows
+    if len(out) == 0:
+        return {"points": 0, "p_coeff_bias": None, "p_coeff_rms": None, "phase_bias": None, "phase_rms": None}
+    p_error = out["p_coeff"].to_numpy() - p_coeff*1e6
+    phase_error = np.remainder(out["phase"].to_numpy() - phase + 180, 360) - 180
+    return {"points": len(out),
+            "p_coeff_bias": float(np.nanmedian(p_error)),
+            "p_coeff_rms": float(np.sqrt(np.nanmean(p_error**2))),
+            "phase_bias": float(np.nanmedian(phase_error)),
+            "phase_rms": float(np.sqrt(np.nanmean(phase_error**2)))}
+
+
+def _format(value):
+    return "-" if value is None else "{:+.3f}".format(value)
+
+
+def git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output = True, text = True,
+                              check = True, cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        return None
+
+
+def run_benchmark(durations = (600, 3600, 20000, 50000), engines = tuple(ENGINES), repeats = 1, memory = True,
+                  **run_kwargs):
+    # One result per duration and engine. The runtime is the fastest of repeats runs,
+    # the peak memory is measured in one more run with tracemalloc, which slows it down.
+    run_kwargs.setdefault("p_coeff", 30e-6)
+    run_kwargs.setdefault("phase", 90)
+    run_kwargs.setdefault("electrode_area", 240e-6)
+    run_kwargs.setdefault("freq", 0.01)
+    results = {"version": git_version(),
+               "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+               "python": platform.python_version(),
+               "numpy": np.__version__,
+               "machine": platform.machine(),
+               "run": run_kwargs,
+               "results": []}
+    for duration in durations:
+        df = synthetic_run(duration, **run_kwargs)
+        for name in engines:
+            runtimes = []
+            for repeat in range(repeats):
+                start = time.perf_counter()
+                out = run_analysis(df, name, run_kwargs["electrode_area"], run_kwargs["freq"])
+                runtimes.append(time.perf_counter() - start)
+            result = {"engine": name, "duration_s": duration, "rows": len(df), "runtime_s": min(runtimes)}
+            if memory:
+                tracemalloc.start()
+                run_analysis(df, name, run_kwargs["electrode_area"], run_kwargs["freq"])
+                result["peak_memory_mb"] = tracemalloc.get_traced_memory()[1]/2**20
+                tracemalloc.stop()
+            result.update(errors(out, run_kwargs["p_coeff"], run_kwargs["phase"]))
+            results["results"].append(result)
+            print("{:<24} {:>6g} s  {:>7} rows  {:>8.3f} s  {:>6} MB  p_coeff bias {} rms {} uC/K/m2  "
+                  "phase bias {} rms {} deg".format(name, duration, len(df), result["runtime_s"],
+                  "{:.1f}".format(result["peak_memory_mb"]) if memory else "-",
+                  *[_format(result[key]) for key in ("p_coeff_bias", "p_coeff_rms", "phase_bias", "phase_rms")]))
+    return results
+
+
+def compare(results, baseline):
+    # Runtime ratio and error changes against an earlier result file
+    previous = {(result["engine"], result["duration_s"]): result for result in baseline["results"]}
+    print("Compared with {} ({})".format(baseline.get("version"), baseline.get("date")))
+    for result in results["results"]:
+        old = previous.get((result["engine"], result["duration_s"]))
+        if old is None:
+            continue
+        changes = [None if result[key] is None or old[key] is None else result[key] - old[key]
+                   for key in ("p_coeff_rms", "phase_rms")]
+        print("{:<24} {:>6g} s  runtime x{:.2f}  p_coeff rms {}  phase rms {}".format(
+            result["engine"], result["duration_s"], result["runtime_s"]/old["runtime_s"], *map(_format, changes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark the accuracy and speed of the analysis on synthetic runs.")
+    parser.add_argument("--durations", type = float, nargs = "+", default = [600, 3600, 20000, 50000],
+                        help = "Run durations in seconds")
+    parser.add_argument("--engines", choices = list(ENGINES), nargs = "+", default = list(ENGINES))
+    parser.add_argument("--repeats", type = int, default = 1)
+    parser.add_argument("--no-memory", action = "store_true", help = "Skip the tracemalloc run")
+    parser.add_argument("--p-coeff", type = float, default = 30e-6, help = "Pyroelectric coefficient in C/K/m2")
+    parser.add_argument("--phase", type = float, default = 90, help = "Phase in deg")
+    parser.add_argument("--current-noise", type = float, default = 5e-12, help = "Current noise in A")
+    parser.add_argument("--temp-noise", type = float, default = 0.005, help = "Temperature noise in K")
+    parser.add_argument("--temp-slope", type = float, default = 0.002, help = "Temperature drift in K/s")
+    parser.add_argument("--sample-period", type = float, default = 0.1, help = "Mean sample interval in s")
+    parser.add_argument("--jitter", type = float, default = 0.3, help = "Relative sample interval jitter")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", help = "Write the results to this JSON file")
+    parser.add_argument("--baseline", help = "Compare with the results in this JSON file")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.durations, args.engines, args.repeats, not args.no_memory,
+                            p_coeff = args.p_coeff, phase = args.phase, current_noise = args.current_noise,
+                            temp_noise = args.temp_noise, temp_slope = args.temp_slope,
+                            sample_period = args.sample_period, jitter = args.jitter, seed = args.seed)
+    if args.baseline:
+        with open(args.baseline) as fd:
+            compare(results, json.load(fd))
+    if args.output:
+        with open(args.output, "w") as fd:
+            json.dump(results, fd, indent = 2)
+
+
+if __name__ == "__main__":
+    main()
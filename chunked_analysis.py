@@ -0,0 +1,106 @@
+# ============================================================================
+# Name        : chunked_analysis.py
+# Version     : 1.0.0
+# Description : Out-of-core analysis of recorded runs. The run is read in
+#               chunks, decimated by the stride analyze() uses and analyzed in
+#               blocks of windows; the last window-1 decimated points of a
+#               block are carried over to the next one. Every block is written
+#               to the output file as soon as it is analyzed, so the memory
+#               used does not grow with the length of the run. The blocks are
+#               aligned with the batches of the sliding window functions, so
+#               the output is identical to analyze(..., decimation = "stride").
+#               Example: python chunked_analysis.py run.csv --output runREANALYZED
+# ============================================================================
+
+import argparse
+import time
+import numpy as np
+
+from data_postprocessing import WINDOW_CHUNK, decimation_ratio, analyze_windows, analysis_frame
+from run_format import RUN_COLUMNS, iter_run, run_extent
+from analysis_io import AnalysisWriter
+
+
+class ChunkedAnalyzer:
+    # Takes the raw rows of a run in order with add() and writes the rows of analyze() for them.
+    # ratio is the decimation stride, which depends on the length of the whole run (see run_extent()).
+    def __init__(self, writer, electrode_area, ratio, freq = 0.01, window = 51, engine = "leastsq",
+                 phase_method = "loop", block_windows = 4*WINDOW_CHUNK):
+        assert window % 2 == 1, "The window must be odd"
+        assert ratio >= 1, "The run is shorter than one decimated point per sample"
+        assert block_windows % WINDOW_CHUNK == 0, "block_windows must be a multiple of WINDOW_CHUNK"
+        self.writer = writer
+        self.electrode_area = electrode_area
+        self.ratio = ratio
+        self.freq = freq
+        self.margin = int((window-1)/2)
+        self.engine = engine
+        self.phase_method = phase_method
+        self.block_windows = block_windows
+        self.rows_seen = 0
+        self.buffer = np.empty((3, 0)) # Decimated time, ext_temp and current not yet analyzed
+
+    def add(self, df):
+        # Raw rows with time, ext_temp and current, the global row numbers that are multiples of ratio are kept
+        first = -self.rows_seen % self.ratio
+        self.rows_seen += len(df)
+        kept = [np.array(df[column].iloc[first::self.ratio], dtype = float) for column in ("time", "ext_temp", "current")]
+        self.buffer = np.concatenate([self.buffer, np.array(kept)], axis = 1)
+        n_points = self.block_windows + 2*self.margin
+        while self.buffer.shape[1] >= n_points:
+            self._analyze(self.buffer[:, :n_points])
+            self.buffer = self.buffer[:, self.block_windows:]
+
+    def _analyze(self, points):
+        rows = analyze_windows(points[0], points[1], points[2], self.electrode_area, self.freq, self.margin,
+                               self.engine, self.phase_method)
+        if rows:
+            self.writer.write(analysis_frame(rows))
+
+    def close(self):
+        # Analyze the points left, fewer than one block
+        if self.buffer.shape[1] > 2*self.margin:
+            self._analyze(self.buffer)
+        self.buffer = np.empty((3, 0))
+        return self.writer.close()
+
+
+def analyze_chunked(run_file, file_name, electrode_area, points_p_period = 10, freq = 0.01, window = 51,
+                    engine = "leastsq", phase_method = "loop", output_format = "parquet", chunk_rows = 100000,
+                    columns = RUN_COLUMNS):
+    # analyze() of a run file with bounded memory, written to file_name plus the extension
+    # of output_format. Only the stride decimation is available: resampling filters the
+    # whole record at once. Returns the path written.
+    print("analyzing data in chunks...")
+    n_rows, experiment_time = run_extent(run_file, columns, chunk_rows)
+    ratio = decimation_ratio(n_rows, experiment_time, points_p_period, freq)
+    analyzer = ChunkedAnalyzer(AnalysisWriter(file_name, output_format), electrode_area, ratio, freq, window, engine,
+                               phase_method)
+    for chunk in iter_run(run_file, columns, chunk_rows, usecols = ["time", "ext_temp", "current"]):
+        analyzer.add(chunk)
+    return analyzer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Analyze a recorded run in chunks with bounded memory.")
+    parser.add_argument("run", help = "Run file, .csv or .run")
+    parser.add_argument("--output", help = "Output file name without extension, default <run>REANALYZED")
+    parser.add_argument("--electrode-area", type = float, default = 240e-6, help = "Electrode area in m2")
+    parser.add_argument("--points-p-period", type = int, default = 10)
+    parser.add_argument("--freq", type = float, default = 0.01, help = "Temperature frequency in Hz")
+    parser.add_argument("--window", type = int, default = 51, help = "Analysis window in points, odd")
+    parser.add_argument("--engine", choices = ["leastsq", "linear"], default = "linear")
+    parser.add_argument("--phase-method", choices = ["loop", "batched"], default = "batched")
+    parser.add_argument("--output-format", choices = ["parquet", "feather", "run", "csv"], default = "parquet")
+    parser.add_argument("--chunk-rows", type = int, default = 100000, help = "Rows read at a time from CSV files")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    output = args.output or args.run.rsplit(".", 1)[0] + "REANALYZED"
+    path = analyze_chunked(args.run, output, args.electrode_area, args.points_p_period, args.freq, args.window,
+                           args.engine, args.phase_method, args.output_format, args.chunk_rows)
+    print("Wrote {} in {:.1f} s".format(path, time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,9 +3,11 @@ import time
 
 sys.path.append(".")
 from coldplate_serialcom import ColdPlate_serialcom
+from setpoint_shadow import SetpointShadow
 
 class COLDPLATE:
     def __init__(self, port):
+        self.shadow = SetpointShadow("COLDPLATE") # Temperatures are set in 0.1 deg steps
         try:
             self.coldplate = ColdPlate_serialcom(port)
             print('Coldplate device created')
@@ -16,6 +18,11 @@ class COLDPLATE:
         self.coldplate.ask("toff")
         del self.coldplate
 
+    def write_setpoint(self, command):
+        # False if the coldplate did not answer (error or read timeout), so the shadow does not record the value
+        response = self.coldplate.ask(command)
+        return response is not None and response != ""
+
     def get_version(self):
         response = self.coldplate.ask("version")
         return response
@@ -37,27 +44,21 @@ class COLDPLATE:
         return round(float(response), 2)
 
     def set_tempTarget(self, temp):
-        temp = int(round(float(temp), 1)*10)
-        command = "stt" + str(temp)
-        self.coldplate.ask(command)
+        self.shadow.apply("stt", temp, lambda temp: self.write_setpoint("stt" + str(int(round(temp*10)))), resolution = 0.1)
 
     def get_tempTarget(self, temp):
         response = self.coldplate.ask("gtt")
         return round(float(response), 1)
 
     def set_tempLimiterMin(self, temp):
-        temp = int(round(float(temp), 1)*10)
-        command = "stlmin" + str(temp)
-        self.coldplate.ask(command)
+        self.shadow.apply("stlmin", temp, lambda temp: self.write_setpoint("stlmin" + str(int(round(temp*10)))), resolution = 0.1)
 
     def get_tempLimiterMin(self):
         response = self.coldplate.ask("gtlmin")
         return round(float(response), 1)
 
     def set_tempLimiterMax(self, temp):
-        temp = int(round(float(temp), 1)*10)
-        command = "stlmax" + str(temp)
-        self.coldplate.ask(command)
+        self.shadow.apply("stlmax", temp, lambda temp: self.write_setpoint("stlmax" + str(int(round(temp*10)))), resolution = 0.1)
 
     def get_tempLimiterMax(self):
         response = self.coldplate.ask("gtlmax")
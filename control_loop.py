@@ -0,0 +1,102 @@
+# ============================================================================
+# Name        : control_loop.py
+# Version     : 1.0.0
+# Description : Runs the peltier PID in its own thread at a fixed rate. Wake-up
+#               times follow absolute deadlines (start + n*period), so the rate
+#               does not drift with the time spent computing. The controller
+#               reads the latest Keithley reading from the LatestValueCache and
+#               records wake-up jitter and missed deadlines.
+# ============================================================================
+
+import math
+import threading
+import time
+import numpy as np
+
+
+class FixedRateScheduler:
+    def __init__(self, period):
+        self.period = period
+        self.start = None
+        self.n = 0
+        self.missed = 0 # Deadlines skipped because the previous cycle overran
+        self.jitter = [] # Wake-up delay after each deadline in seconds
+
+    def wait(self, stop_event = None):
+        # Sleep until the next deadline, returns True if stop_event was set meanwhile
+        now = time.perf_counter()
+        if self.start is None:
+            self.start = now
+        self.n += 1
+        deadline = self.start + self.n*self.period
+        if now > deadline:
+            skipped = math.floor((now - deadline)/self.period) + 1
+            self.missed += skipped
+            self.n += skipped
+            deadline = self.start + self.n*self.period
+        delay = deadline - time.perf_counter()
+        if delay > 0:
+            if stop_event is not None:
+                if stop_event.wait(delay):
+                    return True
+            else:
+                time.sleep(delay)
+        self.jitter.append(time.perf_counter() - deadline)
+        return False
+
+    def report(self):
+        if not self.jitter:
+            return "No control cycles run"
+        jitter = np.array(self.jitter)*1000
+        return "{} cycles at {} ms, jitter mean: {} ms  p99: {} ms  max: {} ms, missed deadlines: {}".format(
+            len(jitter), round(self.period*1000, 3), round(jitter.mean(), 3),
+            round(np.percentile(jitter, 99), 3), round(jitter.max(), 3), self.missed)
+
+
+class ControlLoop(threading.Thread):
+    # setpoint(tdelta) gives the target temperature at instrument time tdelta and
+    # output(value) applies the controller output, e.g. by queueing it on the
+    # CPX400SP poller. The last target and output are published to the cache.
+    def __init__(self, pid, cache, setpoint, output, period = 0.1, limit = None,
+                 reading_key = "keithley", time_index = 1, temp_index = 2):
+        threading.Thread.__init__(self, name = "PID", daemon = True)
+        self.pid = pid
+        self.pid.sample_time = None # The scheduler owns the timing
+        self.cache = cache
+        self.setpoint = setpoint
+        self.output = output
+        self.limit = limit # Upper limit of the output, to avoid damaging the peltier element
+        self.reading_key = reading_key
+        self.time_index = time_index
+        self.temp_index = temp_index
+        self.scheduler = FixedRateScheduler(period)
+        self.errors = 0
+        self._stop_event = threading.Event()
+
+    def step(self):
+        reading = self.cache.get(self.reading_key)
+        if reading is None:
+            return
+        target = self.setpoint(reading[self.time_index])
+        self.pid.setpoint = target
+        value = self.pid(reading[self.temp_index])
+        if self.limit is not None and value > self.limit:
+            value = self.limit
+        self.output(value)
+        self.cache.update(new_target_temp = target, pid_out_volt = value)
+
+    def run(self):
+        while not self.scheduler.wait(self._stop_event):
+            try:
+                self.step()
+            except Exception as e:
+                self.errors += 1
+                print("{}: control step failed: {}".format(self.name, e))
+
+    def stop(self, timeout = 5):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def report(self):
+        return "PID control: {}, {} errors".format(self.scheduler.report(), self.errors)
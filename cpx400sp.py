@@ -12,9 +12,11 @@ import sys
 
 sys.path.append(".")
 from tcp_socket import TCP_Socket
+from setpoint_shadow import SetpointShadow
 
 class CPX400SP:
     def __init__(self, ip, port):
+        self.shadow = SetpointShadow("CPX400SP") # Settings resolution: 10 mV, 1 mA
         try:
             self.cpx = TCP_Socket(ip, port)
             print('Device created')
@@ -22,6 +24,7 @@ class CPX400SP:
             print('Failed to create device')
 
     def __del__(self):
+        self.shadow.invalidate('OP1') # Always switch the output off, whatever was recorded
         self.set_output(0)
         del self.cpx
 
@@ -30,23 +33,25 @@ class CPX400SP:
         return response
 
     def set_voltage(self, v):
-        command = 'V1 ' + str(v)
-        self.cpx.send(command)
+        self.shadow.apply('V1', v, lambda v: self.cpx.send('V1 ' + str(v)), resolution = 0.01)
 
     def get_voltage(self):
         voltage = self.cpx.ask('V1O?')
         return voltage
 
     def set_current(self, i):
-        command = 'I1 ' + str(i)
-        self.cpx.send(command)
+        self.shadow.apply('I1', i, lambda i: self.cpx.send('I1 ' + str(i)), resolution = 0.001)
 
     def get_current(self):
         current = self.cpx.ask('I1O?')
         return current
 
+    def get_readback(self):
+        # Output voltage and current read back in a single pipelined round trip
+        voltage, current = self.cpx.ask_many(['V1O?', 'I1O?'])
+        return float(voltage.strip()[:-1]), float(current.strip()[:-1])
+
     def set_output(self, bool_value):
         # Turn output ON and OFF with '1' and '0'
-        command = 'OP1 ' + str(bool_value)
-        self.cpx.send(command)
+        self.shadow.apply('OP1', bool_value, lambda state: self.cpx.send('OP1 ' + str(state)))
         
\ No newline at end of file
@@ -6,39 +6,248 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from scipy.optimize import leastsq, curve_fit
-from scipy.signal import hilbert
+from scipy.signal import hilbert, resample_poly
 from datetime import datetime
 from general_functions import new_datefolder
 from scipy.signal import correlate, correlation_lags, detrend
 import ntpath
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import seaborn as sns
 sns.set_style("ticks")
 
-def analyze(df, electrode_area, points_p_period = 10, freq = 0.01, window = 51 ):
-    print("analyzing data...")
+from plot_pyramid import DownsamplePyramid, plot_pyramid
 
-    df = df[["time", "current", "ext_temp"]]
+WINDOW_CHUNK = 4096 # Windows solved per batch by the sliding window functions
+# Part of the analysis cache key: bump it whenever analyze_windows(), decimate() or the
+# p_coeff formula change the results, so entries of older versions are not returned
+ANALYSIS_VERSION = 2
 
-    #SAMPLE to reduce file size ########################################
-    experiment_time = df["time"].iloc[-1]
-    sampling_rate = experiment_time/len(df["time"])
+def hil(A, B):
+    A_h = hilbert(A)
+    B_h = hilbert(B)
+    c = np.inner( A_h, np.conj(B_h) ) / math.sqrt( np.inner(A_h,np.conj(A_h)) * np.inner(B_h,np.conj(B_h)) )
+    phase_rad = np.angle(c)
+    return math.degrees(phase_rad)
+
+def sine_amplitude(A, t):
+    guess_amp = 1
+    guess_freq = 0.01
+    guess_slope = 0
+    guess_offset = np.mean(A)
+    optimize_func = lambda x: (x[0]*np.sin(2*np.pi*x[1]*t) + x[2] + t*x[3] - A)
+    est_amp, est_freq, est_offset, est_slope = leastsq(optimize_func, [guess_amp, guess_freq, guess_offset, guess_slope])[0]
+    return est_amp
+
+def resample_uniform(t, signals, points_p_period = 10, freq = 0.01):
+    # Resample irregularly timed signals onto the grid t[0] + k/(freq*points_p_period).
+    # The signals are interpolated onto a fine uniform grid close to the original sample
+    # interval, then low-pass filtered and decimated by an integer factor with a zero-phase
+    # polyphase FIR, so content above the new Nyquist frequency does not alias.
+    t = np.asarray(t, dtype = float)
+    period = 1/(freq*points_p_period)
+    factor = max(1, int(round(period/np.median(np.diff(t)))))
+    fine_t = t[0] + np.arange(int((t[-1] - t[0])/(period/factor)) + 1)*(period/factor)
+    resampled = []
+    for y in signals:
+        fine_y = np.interp(fine_t, t, np.asarray(y, dtype = float))
+        resampled.append(resample_poly(fine_y, 1, factor, padtype = "line") if factor > 1 else fine_y)
+    grid = t[0] + np.arange(len(resampled[0]))*period
+    return grid, resampled
+
+def sliding_sine_amplitudes(t, signals, freq, width, chunk = WINDOW_CHUNK):
+    # Amplitude of the linear model a*sin(2*pi*freq*t) + b*cos(2*pi*freq*t) + offset + slope*t
+    # fitted to every window t[s:s+width] of each signal, for s = 0 ... len(t)-width.
+    # All windows are solved at once through their 4x4 normal equations, chunk windows at a time.
+    t = np.asarray(t, dtype = float)
+    signals = [np.asarray(y, dtype = float) for y in signals]
+    n_windows = len(t) - width + 1
+    amplitudes = [np.empty(max(n_windows, 0)) for y in signals]
+    if n_windows <= 0:
+        return amplitudes # Fewer points than one window, e.g. a short or aborted run
+    t_windows = np.lib.stride_tricks.sliding_window_view(t, width)
+    sin_windows = np.lib.stride_tricks.sliding_window_view(np.sin(2*np.pi*freq*t), width)
+    cos_windows = np.lib.stride_tricks.sliding_window_view(np.cos(2*np.pi*freq*t), width)
+    y_windows = [np.lib.stride_tricks.sliding_window_view(y, width) for y in signals]
+    for first in range(0, n_windows, chunk):
+        tw = t_windows[first:first + chunk]
+        X = np.empty(tw.shape + (4,))
+        X[..., 0] = sin_windows[first:first + chunk]
+        X[..., 1] = cos_windows[first:first + chunk]
+        X[..., 2] = 1
+        X[..., 3] = tw - tw.mean(axis = 1, keepdims = True) # Centered for a well conditioned system
+        Xt = X.transpose(0, 2, 1)
+        XtX = Xt @ X
+        for amplitude, yw in zip(amplitudes, y_windows):
+            coefficients = np.linalg.solve(XtX, Xt @ yw[first:first + chunk, :, None])[..., 0]
+            amplitude[first:first + chunk] = np.hypot(coefficients[:, 0], coefficients[:, 1])
+    return amplitudes
+
+def window_phase(Ax, Bx):
+    Ax = np.array(Ax, dtype = float)
+    Bx = np.array(Bx, dtype = float)
+    Ax -= Ax.mean(); Ax /= Ax.std(); Ax = detrend(Ax)
+    Bx -= Bx.mean(); Bx /= Bx.std(); Bx = detrend(Bx)
+    return hil(Ax, Bx)
+
+def sliding_window_phases(A, B, width, chunk = WINDOW_CHUNK):
+    # window_phase() of every window A[s:s+width], B[s:s+width] for s = 0 ... len(A)-width,
+    # normalized, detrended and Hilbert transformed along the rows of a stack of windows
+    if len(A) < width:
+        return np.empty(0) # Fewer points than one window, e.g. a short or aborted run
+    A_windows = np.lib.stride_tricks.sliding_window_view(np.asarray(A, dtype = float), width)
+    B_windows = np.lib.stride_tricks.sliding_window_view(np.asarray(B, dtype = float), width)
+    phases = np.empty(len(A_windows))
+    for first in range(0, len(A_windows), chunk):
+        analytic = []
+        for windows in (A_windows[first:first + chunk], B_windows[first:first + chunk]):
+            x = windows - windows.mean(axis = 1, keepdims = True)
+            x /= x.std(axis = 1, keepdims = True)
+            analytic.append(hilbert(detrend(x, axis = 1), axis = 1))
+        A_h, B_h = analytic
+        c = np.sum(A_h*np.conj(B_h), axis = 1) / np.sqrt(np.sum(np.abs(A_h)**2, axis = 1)*np.sum(np.abs(B_h)**2, axis = 1))
+        phases[first:first + chunk] = np.degrees(np.angle(c))
+    return phases
+
+def p_coefficient(phase, current_amplitude, temp_amplitude, electrode_area, frequency = 0.01):
+    return (np.sin(np.radians(phase))*current_amplitude) / (electrode_area* 2*np.pi*frequency*temp_amplitude)
+
+def analyze_window(tim, Ax, Bx, electrode_area, frequency = 0.01, engine = "leastsq"):
+    # Phase, current amplitude, p_coeff and temperature amplitude of one window of
+    # temperature (Ax) and current (Bx) samples, shared by analyze() and the live analysis
+    tim = np.array(tim, dtype = float)
+    Ax = np.array(Ax, dtype = float)
+    Bx = np.array(Bx, dtype = float)
+    if engine == "linear":
+        temp_amplitude, current_amplitude = [a[0] for a in sliding_sine_amplitudes(tim, [Ax, Bx], frequency, len(tim))]
+    else:
+        temp_amplitude = abs(sine_amplitude(Ax, tim))
+        current_amplitude = abs(sine_amplitude(Bx, tim))
+    T_amp = np.mean(temp_amplitude)
+    phase = window_phase(Ax, Bx)
+    # T_amp = 1
+    p_coeff = p_coefficient(phase, current_amplitude, T_amp, electrode_area, frequency)
+    return phase, current_amplitude, p_coeff, temp_amplitude
+
+def analyze_windows(t, A_values, B_values, electrode_area, freq, margin, engine = "leastsq", phase_method = "loop"):
+    # Rows of analyze() for the points margin ... len(t)-margin-1, point i uses the samples i-margin ... i+margin-1
+    analyzed_data = []
+    if engine == "linear":
+        temp_amplitudes, current_amplitudes = sliding_sine_amplitudes(t, [A_values, B_values], freq, 2*margin)
+    if phase_method == "batched":
+        phases = sliding_window_phases(A_values, B_values, 2*margin)
+    for i in range(margin, len(t)-margin):
+        tim = t[i-margin:i+margin]
+        Ax = A_values[i-margin:i+margin]
+        Bx = B_values[i-margin:i+margin]
+
+        ti = t[i]
+        temp = A_values[i]
+        current = B_values[i]
+        phase = phases[i-margin] if phase_method == "batched" else window_phase(Ax, Bx)
+        if engine == "linear":
+            temp_amplitude = temp_amplitudes[i-margin]
+            current_amplitude = current_amplitudes[i-margin]
+            p_coeff = p_coefficient(phase, current_amplitude, temp_amplitude, electrode_area, freq)
+        elif phase_method == "batched":
+            temp_amplitude = abs(sine_amplitude(Ax, tim))
+            current_amplitude = abs(sine_amplitude(Bx, tim))
+            p_coeff = p_coefficient(phase, current_amplitude, temp_amplitude, electrode_area, freq)
+        else:
+            phase, current_amplitude, p_coeff, temp_amplitude = analyze_window(tim, Ax, Bx, electrode_area, freq)
+        analyzed_data.append([ti, temp, current, phase, current_amplitude, p_coeff, temp_amplitude])
+    return analyzed_data
+
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name = name, track = False)
+    except TypeError: # Python < 3.13 has no track argument
+        return shared_memory.SharedMemory(name = name)
+
+def analyze_shared(name, n, first, stop, electrode_area, freq, margin, engine, phase_method):
+    # Rows of analyze_windows() for points first ... stop-1 of the (time, ext_temp, current) record
+    # of n points in the shared memory segment name, e.g. as a process pool worker
+    shm = _attach(name)
+    try:
+        data = np.ndarray((3, n), dtype = np.float64, buffer = shm.buf)
+        # Copies, so that the segment can be closed while the results are still alive
+        t, A_values, B_values = [np.array(row[first-margin:stop+margin]) for row in data]
+        del data
+        # Returned as one array, pickling a list of NumPy scalars costs more than the analysis
+        rows = analyze_windows(t, A_values, B_values, electrode_area, freq, margin, engine, phase_method)
+        return np.array(rows, dtype = float).reshape(-1, 7)
+    finally:
+        shm.close()
+
+def analyze_parallel(t, A_values, B_values, electrode_area, freq, margin, engine = "leastsq", phase_method = "loop",
+                     workers = None, chunk_size = 2000):
+    # Same rows as analyze_windows(), computed on a process pool. Chunks of chunk_size points
+    # overlap by window-1 samples so every window sees exactly the samples of a serial run.
+    n = len(t)
+    shm = shared_memory.SharedMemory(create = True, size = max(1, 3*n*8))
+    try:
+        data = np.ndarray((3, n), dtype = np.float64, buffer = shm.buf)
+        data[0], data[1], data[2] = t, A_values, B_values
+        del data
+        starts = range(margin, n-margin, chunk_size)
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            futures = [pool.submit(analyze_shared, shm.name, n, first, min(first + chunk_size, n-margin),
+                                   electrode_area, freq, margin, engine, phase_method) for first in starts]
+            # In time order
+            return np.concatenate([future.result() for future in futures] + [np.empty((0, 7))])
+    finally:
+        shm.close()
+        shm.unlink()
+
+def decimation_ratio(n_rows, experiment_time, points_p_period = 10, freq = 0.01):
+    # Stride that leaves about points_p_period points per period of a run of n_rows rows
     periods = experiment_time/(1/freq)
     sample_size = periods * points_p_period
-    ratio = int(len(df["time"])/sample_size)
-    df = df.iloc[::ratio, :]
+    return int(n_rows/sample_size)
 
-    t = np.array(df["time"])
-    A = df["ext_temp"]
-    B = df["current"]
+def decimate(df, points_p_period = 10, freq = 0.01, decimation = "stride"):
+    # Time, temperature and current reduced to about points_p_period points per period,
+    # with the stride ratio and the sampling period used by analyze()
+    experiment_time = df["time"].iloc[-1]
+    sampling_rate = experiment_time/len(df["time"])
+    ratio = decimation_ratio(len(df["time"]), experiment_time, points_p_period, freq)
+    if decimation == "resample":
+        t, (A, B) = resample_uniform(df["time"], [df["ext_temp"], df["current"]], points_p_period, freq)
+        sampling_rate = t[1] - t[0]
+    else:
+        df = df.iloc[::ratio, :]
+        t = np.array(df["time"])
+        A = df["ext_temp"]
+        B = df["current"]
+    return np.array(t, dtype = float), np.array(A, dtype = float), np.array(B, dtype = float), ratio, sampling_rate
 
-    #FUNCTIONS #########################################################
-    def hil(A, B):
-        A_h = hilbert(A)
-        B_h = hilbert(B)
-        c = np.inner( A_h, np.conj(B_h) ) / math.sqrt( np.inner(A_h,np.conj(A_h)) * np.inner(B_h,np.conj(B_h)) )
-        phase_rad = np.angle(c)
-        return math.degrees(phase_rad)
+def analysis_frame(analyzed_data):
+    # Rows of analyze_windows() as the table returned by analyze(), current in nA and p_coeff in uC/K/m2
+    out = pd.DataFrame(analyzed_data, columns = ["time", "temperature", "current", "phase", "amplitude", "p_coeff", "temp_amplitude"])
+    out["current"] = out["current"]*1e9
+    out["amplitude"] = out["amplitude"]*1e9
+    out["p_coeff"] = out["p_coeff"]*1e6
+    return out
+
+def analyze(df, electrode_area, points_p_period = 10, freq = 0.01, window = 51, engine = "leastsq", phase_method = "loop",
+            workers = None, chunk_size = 2000, cache = None, decimation = "stride"):
+    # engine "leastsq" fits amplitude, frequency, offset and slope per window with
+    # scipy.optimize.leastsq, "linear" fits sine and cosine at the known freq plus
+    # offset and slope to all windows in one batched linear least-squares pass.
+    # phase_method "loop" runs hil() per window, "batched" all windows at once.
+    # With workers > 1 the windows are analyzed in chunks of chunk_size points on a process pool.
+    # cache is an optional analysis_cache.AnalysisCache holding the results of earlier calls.
+    # decimation "stride" keeps every ratio-th sample, "resample" low-pass filters and resamples
+    # onto a uniform grid of points_p_period points per period (see resample_uniform()).
+    print("analyzing data...")
+
+    df = df[["time", "current", "ext_temp"]]
+    raw = df
 
+    #SAMPLE to reduce file size ########################################
+    t, A, B, ratio, sampling_rate = decimate(df, points_p_period, freq, decimation)
+
+    #FUNCTIONS #########################################################
     def xcorr(A, B):
         phase = correlate(A, B)
         lags = correlation_lags(len(A), len(B))
@@ -47,53 +256,43 @@ def analyze(df, electrode_area, points_p_period = 10, freq = 0.01, window = 51 )
         phase_deg = math.degrees(lag*sampling_rate*(2*np.pi*freq))
         return phase_deg
 
-    def sine(A, t):
-        guess_amp = 1
-        guess_freq = 0.01
-        guess_slope = 0
-        guess_offset = np.mean(A)
-        optimize_func = lambda x: (x[0]*np.sin(2*np.pi*x[1]*t) + x[2] + t*x[3] - A)
-        est_amp, est_freq, est_offset, est_slope = leastsq(optimize_func, [guess_amp, guess_freq, guess_offset, guess_slope])[0]
-        data_fit = est_amp*np.sin(2*np.pi*freq*t) + est_offset
-        return est_amp
+    margin = int((window-1)/2)
+    assert(window % 2 == 1)
+    A_values, B_values = A, B
 
-    analyzed_data = []
-    for i in range(len(A)):
-        margin = int((window-1)/2)
-        assert(window % 2 == 1)
-        if margin <= i < len(A)-margin:
-            tim = t[i-margin:i+margin].copy()
-            Ax = A[i-margin:i+margin].copy()
-            Bx = B[i-margin:i+margin].copy()
-
-            ti = t[i]
-            temp = np.array(A)[i]
-            temp_amplitude = abs(sine(Ax, tim))
-            T_amp = np.mean(temp_amplitude)
-            current = np.array(B)[i]
-            current_amplitude = abs(sine(Bx, tim))
-
-            Ax -= Ax.mean(); Ax /= Ax.std(); Ax = detrend(Ax)
-            Bx -= Bx.mean(); Bx /= Bx.std(); Bx = detrend(Bx)
-
-            phase = hil(Ax, Bx)
-            frequency = 0.01
-            # T_amp = 1
-            p_coeff = (np.sin(math.radians(phase))*current_amplitude) / (electrode_area* 2*np.pi*frequency*T_amp)
-            analyzed_data.append([ti, temp, current, phase, current_amplitude, p_coeff, temp_amplitude])
+    def compute(first = 0):
+        # Rows of the points margin+first ... len(t)-margin-1
+        if workers is not None and workers > 1:
+            rows = analyze_parallel(t[first:], A_values[first:], B_values[first:], electrode_area, freq, margin,
+                                    engine, phase_method, workers = workers, chunk_size = chunk_size)
+        else:
+            rows = analyze_windows(t[first:], A_values[first:], B_values[first:], electrode_area, freq, margin,
+                                   engine, phase_method)
+        return np.array(rows, dtype = float).reshape(-1, 7)
 
-    out = pd.DataFrame(analyzed_data, columns = ["time", "temperature", "current", "phase", "amplitude", "p_coeff", "temp_amplitude"])
-    out["current"] = out["current"]*1e9
-    out["amplitude"] = out["amplitude"]*1e9
-    out["p_coeff"] = out["p_coeff"]*1e6
+    if cache is not None:
+        # The decimation ratio is part of the key, a run extended at another ratio is analyzed again
+        params = {"analysis_version": ANALYSIS_VERSION, "electrode_area": electrode_area,
+                  "points_p_period": points_p_period, "freq": freq,
+                  "window": window, "engine": engine, "phase_method": phase_method, "ratio": ratio}
+        if decimation == "resample":
+            # The filter reaches back from the end of the record, so a prefix is not extended
+            params.update(decimation = decimation, n_rows = len(raw))
+        analyzed_data = cache.get([raw[column] for column in raw.columns], params, compute)
+    else:
+        analyzed_data = compute()
+
+    out = analysis_frame(analyzed_data)
     
     fig, axs = plt.subplots(2, figsize=(10,4), sharex=True, sharey=False)
     #fig.suptitle(file_name)
     ax0, ax1, ax2, ax3 = axs[0], axs[0].twinx(), axs[1], axs[1].twinx()
-    ax0.plot(out["time"], out["temperature"], color = "blue")
-    ax1.plot(out["time"], out["current"], color = "red")
-    ax2.plot(out["time"], out["phase"], color = "black")
-    ax3.plot(out["time"], out["p_coeff"], color = "green")
+    # Long runs are drawn from a min/max pyramid at the resolution of the axes
+    pyramid = DownsamplePyramid.build(out)
+    plot_pyramid(ax0, pyramid, "temperature", color = "blue")
+    plot_pyramid(ax1, pyramid, "current", color = "red")
+    plot_pyramid(ax2, pyramid, "phase", color = "black")
+    plot_pyramid(ax3, pyramid, "p_coeff", color = "green")
     #ax4.plot(out["time"], out["amplitude"], color = "pink")
     ax0.set_yticks([20, 40, 60, 80, 100, 120, 140])
     ax1.set_yticks(np.linspace(-20, 20, 9))
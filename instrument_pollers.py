@@ -0,0 +1,161 @@
+# ============================================================================
+# Name        : instrument_pollers.py
+# Version     : 1.0.0
+# Description : One polling thread per instrument and a thread-safe cache
+#               holding the latest value read from each of them. The Keithley
+#               poller feeds a queue that paces the acquisition loop, while the
+#               slower peripherals (CPX400SP, COLDPLATE) refresh the cache and
+#               apply the most recent setpoint on their own schedule.
+# ============================================================================
+
+import queue
+import threading
+import time
+
+
+class LatestValueCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._stamps = {}
+
+    def update(self, **values):
+        now = time.time()
+        with self._lock:
+            for key, value in values.items():
+                self._values[key] = value
+                self._stamps[key] = now
+
+    def get(self, key, default = None):
+        with self._lock:
+            return self._values.get(key, default)
+
+    def age(self, key):
+        # Seconds since the value was last refreshed, None if never read
+        with self._lock:
+            stamp = self._stamps.get(key)
+        return None if stamp is None else time.time() - stamp
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+
+class InstrumentPoller(threading.Thread):
+    # Owns one instrument: every query and every write to it happens in this
+    # thread once the poller is started, so the drivers need no locking.
+    def __init__(self, name, cache, queries, period = 0):
+        threading.Thread.__init__(self, name = name, daemon = True)
+        self.cache = cache
+        self.queries = queries # {cache key: callable returning the value}
+        self.period = period # Minimum time between two polling rounds in seconds
+        self.errors = 0
+        self.rounds = 0
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._wake = threading.Event() # Set by command() and stop() to end the wait between rounds
+
+    def command(self, key, function, *args):
+        # Queue a write; only the most recent command for each key is applied
+        with self._pending_lock:
+            self._pending[key] = (function, args)
+        self._wake.set()
+
+    def stop(self, timeout = 5):
+        self._stop_event.set()
+        self._wake.set()
+        if self.is_alive():
+            self.join(timeout)
+        self._apply_pending()
+
+    def _apply_pending(self):
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        for key, (function, args) in pending.items():
+            try:
+                function(*args)
+            except Exception as e:
+                self.errors += 1
+                print("{}: command {} failed: {}".format(self.name, key, e))
+
+    def poll(self):
+        for key, query in self.queries.items():
+            try:
+                if isinstance(key, tuple):
+                    self.cache.update(**dict(zip(key, query()))) # Query returning several values
+                else:
+                    self.cache.update(**{key: query()})
+            except Exception as e:
+                self.errors += 1
+                print("{}: query {} failed: {}".format(self.name, key, e))
+
+    def run(self):
+        # Commands are applied as soon as they are queued, the queries once per period
+        next_poll = 0
+        while not self._stop_event.is_set():
+            self._wake.clear()
+            self._apply_pending()
+            if time.time() >= next_poll:
+                next_poll = time.time() + self.period
+                self.poll()
+                self.rounds += 1
+            wait = next_poll - time.time()
+            if wait > 0:
+                self._wake.wait(wait)
+
+
+class KeithleyPoller(InstrumentPoller):
+    # Reads continuously and hands every reading to the acquisition loop, so the
+    # next read? is already on the wire while the loop handles the previous one.
+    def __init__(self, k, cache, maxsize = 1000):
+        InstrumentPoller.__init__(self, "KEITHLEY6517", cache, {})
+        self.k = k
+        self.dropped = 0
+        self.readings = queue.Queue(maxsize = maxsize)
+
+    def poll(self):
+        try:
+            reading = self.k.read_latest()
+        except Exception as e:
+            self.errors += 1
+            print("{}: read failed: {}".format(self.name, e))
+            return
+        self.cache.update(keithley = list(reading)) # The loop extends the queued reading in place
+        try:
+            self.readings.put_nowait(reading)
+        except queue.Full:
+            self.dropped += 1 # Never stall the instrument on a stalled consumer
+
+    def next_reading(self, timeout = None):
+        # Blocks until the instrument delivers the next reading
+        return self.readings.get(timeout = timeout)
+
+
+def start_pollers(k, cp, cpx, peripheral_period = 0.5, keithley_poller = KeithleyPoller, **keithley_kwargs):
+    # Start one worker per instrument and return them with their shared cache. The
+    # peripherals are read back every peripheral_period seconds, setpoints are written at once.
+    cache = LatestValueCache()
+    k_poller = keithley_poller(k, cache, **keithley_kwargs)
+    if hasattr(k_poller, "configure"):
+        k_poller.configure()
+    cpx_poller = InstrumentPoller("CPX400SP", cache,
+                                  {("pelt_volt", "pelt_curr"): cpx.get_readback},
+                                  period = peripheral_period)
+    cp_poller = InstrumentPoller("COLDPLATE", cache,
+                                 {"int_temp": lambda: round(cp.get_tempActual(), 3)},
+                                 period = peripheral_period)
+    # Fill the cache once so the first rows are complete
+    cpx_poller.poll()
+    cp_poller.poll()
+    for poller in (k_poller, cpx_poller, cp_poller):
+        poller.start()
+    return cache, k_poller, cpx_poller, cp_poller
+
+
+def stop_pollers(*pollers):
+    for poller in pollers:
+        poller.stop()
+        print("{} stopped after {} rounds, {} errors".format(poller.name, poller.rounds, poller.errors))
+        if getattr(poller, "dropped", 0) > 0:
+            print("{}: {} readings dropped, the acquisition loop did not keep up".format(poller.name, poller.dropped))
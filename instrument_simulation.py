@@ -0,0 +1,357 @@
+# ============================================================================
+# Name        : instrument_simulation.py
+# Version     : 1.0.0
+# Description : Local stand-ins for the bench instruments, to run and benchmark
+#               the acquisition loop without hardware:
+#               - SimulatedResourceManager: VISA-level KEITHLEY6517 backend
+#               - FakeCPXServer: CPX400SP on a local TCP port
+#               - FakeColdplate: coldplate on a pseudo-terminal
+#               All of them share a ThermalPlant that models the sample and
+#               coldplate temperatures and the pyroelectric current, and each
+#               has a configurable response latency.
+# ============================================================================
+
+import os
+import select
+import socket
+import socketserver
+import threading
+import time
+import numpy as np
+
+from keithley6517_commands import KEITHLEY6517
+from coldplate_commands import COLDPLATE
+from cpx400sp import CPX400SP
+
+
+class ThermalPlant:
+    # Sample temperature: dT/dt = (T_plate - T)/tau_sample + pelt_gain*V
+    # Coldplate temperature follows its target with time constant tau_plate.
+    # Pyroelectric current: I = p_coeff*area*dT/dt + offset + noise.
+    def __init__(self, ambient = 25, tau_sample = 20, tau_plate = 60, pelt_gain = 0.5,
+                 p_coeff = 30e-6, electrode_area = 240e-6, current_offset = 0, current_noise = 5e-12,
+                 temp_noise = 0.005, time_scale = 1, step = 0.05, history = 200000, seed = None):
+        self.tau_sample = tau_sample
+        self.tau_plate = tau_plate
+        self.pelt_gain = pelt_gain # K/s per V applied to the peltier element
+        self.p_coeff = p_coeff
+        self.electrode_area = electrode_area
+        self.current_offset = current_offset
+        self.current_noise = current_noise
+        self.temp_noise = temp_noise
+        self.time_scale = time_scale # Plant seconds per wall-clock second
+        self.step = step # Integration step in plant seconds
+        self.history = history
+        self.rng = np.random.default_rng(seed)
+        self.sample_temp = ambient
+        self.plate_temp = ambient
+        self.plate_target = ambient
+        self.plate_on = False
+        self.pelt_voltage = 0
+        self.dtemp = 0
+        self.tstamp_zero = 0
+        self._t = 0
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._times = []
+        self._temps = []
+        self._dtemps = []
+
+    def now(self):
+        return (time.perf_counter() - self._start)*self.time_scale
+
+    def advance(self):
+        with self._lock:
+            target = self.now()
+            while self._t < target:
+                dt = min(self.step, target - self._t)
+                if self.plate_on:
+                    self.plate_temp += (self.plate_target - self.plate_temp)*dt/self.tau_plate
+                self.dtemp = (self.plate_temp - self.sample_temp)/self.tau_sample + self.pelt_gain*self.pelt_voltage
+                self.sample_temp += self.dtemp*dt
+                self._t += dt
+                self._times.append(self._t)
+                self._temps.append(self.sample_temp)
+                self._dtemps.append(self.dtemp)
+            if len(self._times) > self.history:
+                del self._times[:-self.history], self._temps[:-self.history], self._dtemps[:-self.history]
+            return self._t
+
+    def reading(self):
+        # Keithley reading now: current, tstamp, ext_temp, vsource
+        now = self.advance()
+        current = self.p_coeff*self.electrode_area*self.dtemp + self.current_offset + self.rng.normal(0, self.current_noise)
+        return [current, now - self.tstamp_zero, self.sample_temp + self.rng.normal(0, self.temp_noise), 0.0]
+
+    def readings(self, times):
+        # Readings at past plant times, interpolated from the recorded history
+        self.advance()
+        with self._lock:
+            history = np.array(self._times)
+            temps = np.interp(times, history, self._temps)
+            dtemps = np.interp(times, history, self._dtemps)
+        n = len(times)
+        current = self.p_coeff*self.electrode_area*dtemps + self.current_offset + self.rng.normal(0, self.current_noise, n)
+        return np.column_stack([current, np.asarray(times) - self.tstamp_zero,
+                                temps + self.rng.normal(0, self.temp_noise, n), np.zeros(n)])
+
+    def reset_tstamp(self):
+        self.tstamp_zero = self.advance()
+
+
+class SimulatedVisaResource:
+    # Answers the SCPI subset used by KEITHLEY6517, including binary formats and
+    # the trace buffer used by BurstAcquisition.
+    def __init__(self, plant, latency = 0.0, measure_time = 0.02, baud_rate = 19200, emulate_baud = True):
+        self.plant = plant
+        self.latency = latency # Fixed response latency of every query in seconds
+        self.measure_time = measure_time # Integration time of a reading (1 PLC at 50 Hz)
+        self.baud_rate = baud_rate
+        self.emulate_baud = emulate_baud # Add the serial transfer time of the response
+        self.read_termination = '\r'
+        self.timeout = 2000
+        self.data_format = "ascii"
+        self.byte_order = "normal"
+        self.trace_points = 100
+        self.trigger_timer = 0.1
+        self.trace_start = None
+        self.trace_tstamp = "absolute"
+        self._output = b""
+
+    def _transfer(self, data):
+        delay = self.latency
+        if self.emulate_baud:
+            delay += len(data)*10/self.baud_rate
+        time.sleep(delay)
+        self._output += data
+
+    def _encode(self, values):
+        if self.data_format == "ascii":
+            return (",".join("{:+.6E}".format(v) for v in values) + self.read_termination).encode("ascii")
+        dtype = "{}f{}".format("<" if self.byte_order.startswith("swap") else ">",
+                               8 if self.data_format in ("real,64", "dreal") else 4)
+        return b"#0" + np.asarray(values, dtype = dtype).tobytes() + self.read_termination.encode("ascii")
+
+    def _points_actual(self):
+        if self.trace_start is None:
+            return 0
+        elapsed = self.plant.advance() - self.trace_start
+        return int(min(self.trace_points, elapsed//self.trigger_timer + 1))
+
+    def _execute(self, command):
+        header, _, argument = command.partition(" ")
+        argument = argument.strip()
+        if header in ("read?", "measure?"):
+            time.sleep(self.measure_time)
+            self._transfer(self._encode(self.plant.reading()))
+        elif header == "fetch?":
+            self._transfer(self._encode(self.plant.reading()))
+        elif header in ("trace:data?", "trace:data:selected?"):
+            rows = self._points_actual()
+            start, count = [int(float(v)) for v in argument.split(",")] if argument else (0, rows)
+            times = self.trace_start + np.arange(start, min(start + count, rows))*self.trigger_timer
+            readings = self.plant.readings(times)
+            if self.trace_tstamp == "absolute":
+                readings[:, 1] = times - self.trace_start # Referenced to the first reading in the buffer
+            self._transfer(self._encode(readings.ravel()))
+        elif header == "trace:points:actual?":
+            self._transfer("{}{}".format(self._points_actual(), self.read_termination).encode("ascii"))
+        elif header == "*opc?":
+            self._transfer(b"1" + self.read_termination.encode("ascii"))
+        elif header == "*idn?":
+            self._transfer(b"KEITHLEY INSTRUMENTS INC.,MODEL 6517,SIMULATED" + self.read_termination.encode("ascii"))
+        elif header == "status:queue:next?":
+            self._transfer(b'0,"No Error"' + self.read_termination.encode("ascii"))
+        elif header == "trace:free?":
+            self._transfer(b"100000,0" + self.read_termination.encode("ascii"))
+        elif header == "format:data":
+            self.data_format = argument.replace(" ", "")
+        elif header == "format:border":
+            self.byte_order = argument
+        elif header == "trace:points":
+            self.trace_points = int(float(argument))
+        elif header == "trace:tstamp:format":
+            self.trace_tstamp = argument
+        elif header == "trigger:timer":
+            self.trigger_timer = float(argument)
+        elif header == "initiate":
+            self.trace_start = self.plant.advance()
+        elif header in ("trace:clear", "abort"):
+            self.trace_start = None
+        elif header == "system:tstamp:relative:reset":
+            self.plant.reset_tstamp()
+        elif header == "*rst":
+            self.data_format, self.byte_order, self.trace_start = "ascii", "normal", None
+
+    def write(self, message):
+        for command in message.split(";"):
+            command = command.strip().lstrip(":").lower()
+            if command and command != "*wai":
+                self._execute(command)
+
+    def query(self, message):
+        self._output = b""
+        self.write(message)
+        response, self._output = self._output, b""
+        return response.decode("ascii").rstrip(self.read_termination)
+
+    def read_bytes(self, count, break_on_termchar = False):
+        response, self._output = self._output[:count], self._output[count:]
+        return response
+
+    def read_raw(self):
+        response, self._output = self._output, b""
+        return response
+
+    def close(self):
+        pass
+
+
+class SimulatedResourceManager:
+    def __init__(self, plant, **resource_kwargs):
+        self.plant = plant
+        self.resource_kwargs = resource_kwargs
+
+    def list_resources(self):
+        return ("SIM::KEITHLEY6517::INSTR",)
+
+    def open_resource(self, resource, read_termination = '\r'):
+        return SimulatedVisaResource(self.plant, **self.resource_kwargs)
+
+
+class FakeCPXServer(socketserver.ThreadingTCPServer):
+    # CPX400SP lookalike on 127.0.0.1, the output voltage drives the plant's peltier
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, plant, latency = 0.0, resistance = 1.25, port = 0):
+        self.plant = plant
+        self.latency = latency
+        self.resistance = resistance # Peltier element resistance in ohm
+        self.voltage = 0
+        self.current_limit = 0
+        self.output = False
+        socketserver.ThreadingTCPServer.__init__(self, ("127.0.0.1", port), _CPXHandler)
+        self.port = self.server_address[1]
+        self.thread = threading.Thread(target = self.serve_forever, daemon = True)
+        self.thread.start()
+
+    def _apply(self):
+        voltage = self.voltage if self.output else 0
+        if self.resistance*self.current_limit < abs(voltage):
+            voltage = np.sign(voltage)*self.resistance*self.current_limit
+        self.plant.pelt_voltage = voltage
+        return voltage
+
+    def answer(self, command):
+        header, _, argument = command.partition(" ")
+        if header == "V1":
+            self.voltage = float(argument)
+        elif header == "I1":
+            self.current_limit = float(argument)
+        elif header == "OP1":
+            self.output = bool(int(argument))
+        elif header == "V1O?":
+            return "{:.2f}V".format(self._apply())
+        elif header == "I1O?":
+            return "{:.3f}A".format(abs(self._apply())/self.resistance)
+        elif header == "*IDN?":
+            return "THURLBY THANDAR, CPX400SP, SIMULATED"
+        self._apply()
+        return None
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _CPXHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # Answer without Nagle delay
+
+    def handle(self):
+        for line in self.rfile:
+            answer = self.server.answer(line.decode("ascii").strip())
+            if answer is not None:
+                time.sleep(self.server.latency)
+                self.wfile.write((answer + "\r\n").encode("ascii"))
+
+
+class FakeColdplate:
+    # Coldplate lookalike on a pseudo-terminal; self.port can be opened by ColdPlate_serialcom
+    def __init__(self, plant, latency = 0.0):
+        self.plant = plant
+        self.latency = latency
+        self.limits = [-10, 99]
+        self.master, self.slave = os.openpty()
+        self.port = os.ttyname(self.slave)
+        self._stop_event = threading.Event()
+        self.thread = threading.Thread(target = self._serve, daemon = True)
+        self.thread.start()
+
+    def answer(self, command):
+        plant = self.plant
+        plant.advance()
+        if command == "gta":
+            return "{:.2f}".format(plant.plate_temp)
+        if command == "gtt":
+            return "{:.1f}".format(plant.plate_target)
+        if command == "gts":
+            return str(int(plant.plate_on))
+        if command == "ton":
+            plant.plate_on = True
+        elif command == "toff":
+            plant.plate_on = False
+        elif command.startswith("stt"):
+            plant.plate_target = min(max(int(command[3:])/10, self.limits[0]), self.limits[1])
+        elif command.startswith("stlmin"):
+            self.limits[0] = int(command[6:])/10
+        elif command.startswith("stlmax"):
+            self.limits[1] = int(command[6:])/10
+        elif command.startswith("gtlmin"):
+            return "{:.1f}".format(self.limits[0])
+        elif command.startswith("gtlmax"):
+            return "{:.1f}".format(self.limits[1])
+        elif command == "version":
+            return "SIMULATED"
+        return "ok"
+
+    def _serve(self):
+        buffer = b""
+        while not self._stop_event.is_set():
+            ready, _, _ = select.select([self.master], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                buffer += os.read(self.master, 1024)
+            except OSError:
+                return
+            while b"\r" in buffer:
+                line, buffer = buffer.split(b"\r", 1)
+                answer = self.answer(line.decode("ascii").strip())
+                time.sleep(self.latency)
+                os.write(self.master, (answer + "\r\n").encode("ascii"))
+
+    def close(self):
+        self._stop_event.set()
+        self.thread.join(1)
+        os.close(self.master)
+        os.close(self.slave)
+
+
+def simulated_instruments(plant = None, keithley_latency = 0.0, cpx_latency = 0.0, coldplate_latency = 0.0,
+                          measure_time = 0.02, emulate_baud = True):
+    # Drivers connected to the simulated backends, plus a function closing the backends
+    plant = plant if plant is not None else ThermalPlant()
+    rm = SimulatedResourceManager(plant, latency = keithley_latency, measure_time = measure_time, emulate_baud = emulate_baud)
+    k = KEITHLEY6517("SIM::KEITHLEY6517::INSTR", baud_rate = 19200, sleep = 0, resource_manager = rm)
+    server = FakeCPXServer(plant, latency = cpx_latency)
+    cpx = CPX400SP("127.0.0.1", server.port)
+    coldplate = FakeColdplate(plant, latency = coldplate_latency)
+    cp = COLDPLATE(coldplate.port)
+
+    def close():
+        server.close()
+        coldplate.close()
+    return plant, k, cp, cpx, close
@@ -0,0 +1,176 @@
+# ============================================================================
+# Name        : instrumentation.py
+# Version     : 1.0.0
+# Description : Opt-in latency instrumentation. Methods of the instrument
+#               drivers and of their transports are wrapped to record per-call
+#               latency histograms, timeouts and bytes transferred, and the
+#               acquisition loop marks its phases to produce a per-iteration
+#               breakdown. Everything is a no-op unless enabled.
+# ============================================================================
+
+import functools
+import threading
+import time
+import numpy as np
+
+from run_writer import RunWriter
+
+# Histogram bins from 1 us to 100 s, 10 per decade
+BIN_EDGES = np.logspace(-6, 2, 81)
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = np.zeros(len(BIN_EDGES) + 1, dtype = np.int64)
+        self.n = 0
+        self.total = 0
+        self.max = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+
+    def add(self, seconds):
+        self.counts[np.searchsorted(BIN_EDGES, seconds)] += 1
+        self.n += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q):
+        # Upper edge of the bin holding the q-th percentile
+        if self.n == 0:
+            return 0
+        index = np.searchsorted(np.cumsum(self.counts), q/100*self.n)
+        return BIN_EDGES[min(index, len(BIN_EDGES) - 1)]
+
+    def summary(self, name):
+        mean = self.total/self.n if self.n else 0
+        return "{:<36} n: {:>8}  mean: {:>9.3f} ms  p50: {:>9.3f} ms  p99: {:>9.3f} ms  max: {:>9.3f} ms  timeouts: {}  errors: {}  out: {} B  in: {} B".format(
+            name, self.n, mean*1000, self.percentile(50)*1000, self.percentile(99)*1000,
+            self.max*1000, self.timeouts, self.errors, self.bytes_out, self.bytes_in)
+
+
+def _size(value):
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        return sum(_size(v) for v in value)
+    return 0
+
+
+def _is_timeout(error):
+    return "timeout" in type(error).__name__.lower() or "timeout" in str(error).lower()
+
+
+class Instrumentation:
+    def __init__(self, enabled = True):
+        self.enabled = enabled
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._iteration_file = None
+        self._iteration_columns = None
+        self._marks = {}
+        self._last_mark = None
+        self._iteration_start = None
+        self.iterations = 0
+
+    def _histogram(self, name):
+        with self._lock:
+            if name not in self.stats:
+                self.stats[name] = LatencyHistogram()
+            return self.stats[name]
+
+    def record(self, name, seconds, bytes_out = 0, bytes_in = 0, timeout = False, error = False):
+        histogram = self._histogram(name)
+        with self._lock:
+            histogram.add(seconds)
+            histogram.bytes_out += bytes_out
+            histogram.bytes_in += bytes_in
+            histogram.timeouts += timeout
+            histogram.errors += error
+
+    def wrap(self, obj, label, methods, empty_is_timeout = False):
+        # Replace the given methods on this instance by timed versions
+        if not self.enabled or obj is None:
+            return
+        for method in methods:
+            function = getattr(obj, method, None)
+            if function is None:
+                continue
+            setattr(obj, method, self._timed(function, "{}.{}".format(label, method), empty_is_timeout))
+
+    def _timed(self, function, name, empty_is_timeout):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                self.record(name, time.perf_counter() - start, _size(args), timeout = _is_timeout(e), error = not _is_timeout(e))
+                raise
+            timeout = empty_is_timeout and result is not None and _size(result) == 0 and isinstance(result, (str, bytes))
+            self.record(name, time.perf_counter() - start, _size(args), _size(result), timeout = timeout)
+            return result
+        return timed
+
+    def instrument_devices(self, k = None, cp = None, cpx = None):
+        # Wrap both the driver calls and the transport underneath them
+        if not self.enabled:
+            return
+        if k is not None:
+            self.wrap(getattr(k, "keithley6517", None), "VISA", ["write", "query", "read_bytes", "read_raw"])
+            self.wrap(k, "KEITHLEY6517", ["read_latest", "get_latest", "measure", "read_buffer", "buffer_points_actual", "vsource"])
+        if cp is not None:
+            self.wrap(getattr(cp, "coldplate", None), "ColdPlate_serialcom", ["ask", "send", "receive"], empty_is_timeout = True)
+            self.wrap(cp, "COLDPLATE", ["get_tempActual", "set_tempTarget"])
+        if cpx is not None:
+            self.wrap(getattr(cpx, "cpx", None), "TCP_Socket", ["send", "receive", "ask", "ask_many"])
+            self.wrap(cpx, "CPX400SP", ["get_readback", "get_voltage", "get_current", "set_voltage"])
+
+    # Per-iteration breakdown of the acquisition loop
+    def open_iterations(self, path):
+        if self.enabled:
+            self._iteration_file = RunWriter(path, flush_rows = 1000, flush_interval = 10, fsync = "close")
+
+    def start_iteration(self):
+        if self.enabled:
+            self._iteration_start = self._last_mark = time.perf_counter()
+            self._marks = {}
+
+    def mark(self, phase):
+        # Time spent since the previous mark is attributed to phase
+        if not self.enabled or self._last_mark is None:
+            return
+        now = time.perf_counter()
+        self._marks[phase] = self._marks.get(phase, 0) + now - self._last_mark
+        self._last_mark = now
+
+    def end_iteration(self):
+        if not self.enabled or self._iteration_start is None:
+            return
+        total = time.perf_counter() - self._iteration_start
+        self.record("loop.iteration", total)
+        for phase, seconds in self._marks.items():
+            self.record("loop." + phase, seconds)
+        if self._iteration_file is not None:
+            if self._iteration_columns is None:
+                self._iteration_columns = list(self._marks)
+                self._iteration_file.write_row(["iteration", "wall_time", "total"] + self._iteration_columns)
+            self._iteration_file.write_row([self.iterations, round(time.time(), 6), round(total, 6)] +
+                                           [round(self._marks.get(phase, 0), 6) for phase in self._iteration_columns])
+        self.iterations += 1
+
+    def summary(self):
+        with self._lock:
+            return "\n".join(self.stats[name].summary(name) for name in sorted(self.stats))
+
+    def close(self, summary_path = None):
+        if not self.enabled:
+            return
+        if self._iteration_file is not None:
+            self._iteration_file.close()
+        text = self.summary()
+        print(text)
+        if summary_path is not None:
+            with open(summary_path, "w") as fd:
+                fd.write(text + "\n")
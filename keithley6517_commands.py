@@ -1,16 +1,83 @@
 import os
+import string
+from contextlib import contextmanager
 import numpy as np
 import pandas as pd
 import pyvisa as visa
+from setpoint_shadow import SetpointShadow
 from datetime import datetime
 import time
 
 
+# SCPI commands sent by the setter methods: name -> (command, settle).
+# Only commands flagged with settle wait self.sleep afterwards (and act as
+# synchronisation points in a batch); the rest are plain configuration writes.
+COMMANDS = {
+    "status_queue_clear":           ("status:queue:clear", False),
+    "system_zcheck":                ("system:zcheck {}", True),
+    "system_zcorrect":              ("system:zcorrect {}", True),
+    "sense_function":               ("sense:function {}", True),
+    "current_range":                ("current:range {}", True),
+    "voltage_range":                ("voltage:range {}", True),
+    "voltage_guard_state":          ("voltage:guard {}", False),
+    "vsource_limit_state":          ("source:voltage:limit:state {}", False),
+    "vsource_limit":                ("source:voltage:limit {}", False),
+    "vsource_output_state":         ("output1 {}", True),
+    "vsource":                      ("source:voltage {}", True),
+    "vsource_mconnect":             ("source:voltage:mconnect {}", True),
+    "current_nplcycles":            ("current:nplcycles {}", False),
+    "voltage_nplcycles":            ("voltage:nplcycles {}", False),
+    "system_pwrlinesync":           ("system:lsync:state {}", False),
+    "current_average_state":        ("current:average:state {}", False),
+    "current_average_type":         ("current:average:type {}", False),
+    "current_average_tcontrol":     ("current:average:tcontrol {}", False),
+    "current_average_count":        ("current:average:count {}", False),
+    "voltage_average_state":        ("voltage:average:state {}", False),
+    "voltage_average_type":         ("voltage:average:type {}", False),
+    "voltage_average_tcontrol":     ("voltage:average:tcontrol {}", False),
+    "voltage_average_count":        ("voltage:average:count {}", False),
+    "current_median_state":         ("current:median:state {}", False),
+    "current_median_rank":          ("current:median:rank {}", False),
+    "voltage_median_state":         ("voltage:median:state {}", False),
+    "voltage_median_rank":          ("voltage:median:rank {}", False),
+    "current_digits":               ("current:digits {}", False),
+    "voltage_digits":               ("voltage:digits {}", False),
+    "system_tstamp_type":           ("system:tstamp:type {}", False),
+    "system_tstamp_relative_reset": ("system:tstamp:relative:reset", False),
+    "system_tstamp_format":         ("data:tstamp:format {}", False),
+    "buffer_format_tstamp":         ("trace:tstamp:format {}", False),
+    "system_tscontrol":             ("system:tscontrol {}", False),
+    "format_elements":              ("format:elements {}", False),
+    "format_data":                  ("format:data {}", False),
+    "format_border":                ("format:border {}", False),
+    "buffer_format_elements":       ("trace:elements {}", False),
+    "trigger_count":                ("trigger:count {}", False),
+    "trigger_delay":                ("trigger:delay {}", False),
+    "trace_clear":                  ("trace:clear", True),
+    "trace_points":                 ("trace:points {}", False),
+    "trace_feed_control":           ("trace:feed:control {}", False),
+    "trace_feed":                   ("trace:feed {}", False),
+    "trigger_source":               ("trigger:source {}", False),
+    "trigger_timer":                ("trigger:timer {}", False),
+    "abort":                        ("abort", True),
+    "reset":                        ("*RST", True),
+    "clear_reg":                    ("*CLS", False),
+    "initate_measurement":          ("initiate; *WAI", True),
+    "initiate":                     ("initiate", False),
+}
+
+
 class KEITHLEY6517:
-    def __init__(self, resource, baud_rate, sleep):
+    def __init__(self, resource, baud_rate, sleep, resource_manager = None):
+        self.data_format = "ascii" # Data format of the readings, see format_data
+        self.byte_order = "normal" # Byte order of binary readings, see format_border
+        self.n_elements = None # Values per reading, see format_elements
+        self.max_message_length = 200 # Longest semicolon-joined message sent in batch mode
+        self._batch = None
+        self.shadow = SetpointShadow("KEITHLEY6517") # V-source setpoints
         try:
             self.sleep = sleep # Delay allowed for communication
-            rm = visa.ResourceManager()
+            rm = visa.ResourceManager() if resource_manager is None else resource_manager # e.g. a simulated backend
             print("Resource list: {}".format(rm.list_resources()))
             self.keithley6517 = rm.open_resource(resource, read_termination='\r')
             time.sleep(self.sleep) # Wait
@@ -32,189 +99,228 @@ class KEITHLEY6517:
         del self.keithley6517
         print("Safely stopped communication: vsource OFF, device RESET, registers CLEAR.")
 
+    # Command dispatch
+    def write_command(self, name, *args):
+        command, settle = COMMANDS[name]
+        command = command.format(*args)
+        if self._batch is not None:
+            self._batch.append((command, settle))
+            return
+        self.keithley6517.write(command)
+        if settle:
+            time.sleep(self.sleep) # Wait
+    @contextmanager
+    def batch(self, header = "Batch"):
+        # Collect the setter calls made inside the with block and send them as
+        # semicolon-joined messages, synchronised with *OPC?, followed by one
+        # drain of the error queue.
+        self._batch = []
+        try:
+            yield self
+            commands = self._batch
+        finally:
+            self._batch = None
+        self._send_batch(commands, header)
+    def _send_batch(self, commands, header):
+        message = ""
+        for command, settle in commands:
+            part = command if command.startswith("*") else ":" + command # Restart from the root of the command tree
+            if message and len(message) + len(part) + 1 > self.max_message_length:
+                self.keithley6517.write(message)
+                message = ""
+            message = part if not message else message + ";" + part
+            if settle:
+                self.keithley6517.write(message)
+                message = ""
+                self.operation_complete()
+        if message:
+            self.keithley6517.write(message)
+        self.operation_complete()
+        self.status_queue_drain(header)
+    def operation_complete(self):
+        return self.keithley6517.query('*OPC?') # Blocks until all pending operations are finished
+
     # Status
     def status_queue_clear(self):
-        self.keithley6517.write('status:queue:clear') # Clears all messages from Error Queue
-        time.sleep(self.sleep) # Wait
+        self.write_command("status_queue_clear") # Clears all messages from Error Queue
 
     # Calibartion
     def system_zcheck(self, state):
-        self.keithley6517.write('system:zcheck {}'.format(state)) # Set ON or OFF Zero Check
-        time.sleep(self.sleep) # Wait
+        self.write_command("system_zcheck", state) # Set ON or OFF Zero Check
     def system_zcorrect(self, state):
-        self.keithley6517.write('system:zcorrect {}'.format(state)) # Set ON or OFF zero correct
-        time.sleep(self.sleep) # Wait
+        self.write_command("system_zcorrect", state) # Set ON or OFF zero correct
 
     # Measurement type
     def sense_function(self, function):
-        self.keithley6517.write('sense:function {}'.format(function)) # Select measurement function e.g. "VOLT", "CURR"
-        time.sleep(self.sleep) # Wait
+        self.write_command("sense_function", function) # Select measurement function e.g. "VOLT", "CURR"
     def current_range(self, crange):
-        self.keithley6517.write('current:range {}'.format(crange)) #Select current range upper limit
-        time.sleep(self.sleep) # Wait
+        self.write_command("current_range", crange) #Select current range upper limit
     def voltage_range(self, vrange):
-        self.keithley6517.write('voltage:range {}'.format(vrange)) #Select voltage range upper limit
-        time.sleep(self.sleep) # Wait
+        self.write_command("voltage_range", vrange) #Select voltage range upper limit
         
     # Voltage guard
     def voltage_guard_state(self, state):
-        self.keithley6517.write('voltage:guard {}'.format(state)) # Set ON or OFF voltage guard
-        time.sleep(self.sleep) # Wait
+        self.write_command("voltage_guard_state", state) # Set ON or OFF voltage guard
 
     # Voltage source
     def vsource_limit_state(self, state):
-        self.keithley6517.write('source:voltage:limit:state {}'.format(state)) # Set ON or OFF V-source voltatge limit, for safety.
-        time.sleep(self.sleep) # Wait
+        self.write_command("vsource_limit_state", state) # Set ON or OFF V-source voltatge limit, for safety.
     def vsource_limit(self, limit):
-        self.keithley6517.write('source:voltage:limit {}'.format(limit)) # Specify V-source voltage limit, for safety.
-        time.sleep(self.sleep) # Wait
+        self.write_command("vsource_limit", limit) # Specify V-source voltage limit, for safety.
     def vsource_output_state(self, state):
-        self.keithley6517.write('output1 {}'.format(state)) #Set ON or OFF V-source output
-        time.sleep(self.sleep) # Wait
+        self.shadow.apply("vsource_output_state", state, lambda state: self.write_command("vsource_output_state", state)) #Set ON or OFF V-source output
     def vsource(self, voltage):
-        self.keithley6517.write('source:voltage {}'.format(voltage)) # Set the amplitude of the V-source
-        time.sleep(self.sleep) # Wait
+        self.shadow.apply("vsource", voltage, lambda voltage: self.write_command("vsource", voltage), resolution = 0.001) # Set the amplitude of the V-source
     def vsource_mconnect(self, state):
-        self.keithley6517.write('source:voltage:mconnect {}'.format(state)) # Connect V-source LO to Ammeter LO to allow current measurment
+        self.write_command("vsource_mconnect", state) # Connect V-source LO to Ammeter LO to allow current measurment
                                                                     # while applying V-source.
-        time.sleep(self.sleep) # Wait
     # Signal integration
     def current_nplcycles(self, nplcycles):
-        self.keithley6517.write('current:nplcycles {}'.format(nplcycles)) #Integration period based on power line frequency (0.01-10)
-        time.sleep(self.sleep) # Wait
+        self.write_command("current_nplcycles", nplcycles) #Integration period based on power line frequency (0.01-10)
     def voltage_nplcycles(self, nplcycles):
-        self.keithley6517.write('voltage:nplcycles {}'.format(nplcycles)) #Integration period based on power line frequency (0.01-10)
-        time.sleep(self.sleep) # Wait
+        self.write_command("voltage_nplcycles", nplcycles) #Integration period based on power line frequency (0.01-10)
     def system_pwrlinesync(self, state):
-        self.keithley6517.write('system:lsync:state {}'.format(state)) # Enables power line synchronisation.
-        time.sleep(self.sleep) # Wait
+        self.write_command("system_pwrlinesync", state) # Enables power line synchronisation.
 
     # Average filter
     def current_average_state(self, state):
-        self.keithley6517.write('current:average:state {}'.format(state)) #Switch ON or OFF the filter
-        time.sleep(self.sleep) # Wait
+        self.write_command("current_average_state", state) #Switch ON or OFF the filter
     def current_average_type(self, typ):
-        self.keithley6517.write('current:average:type {}'.format(typ)) # Set average filter type: none, scalar or advanced
-        time.sleep(self.sleep) # Wait
+        self.write_command("current_average_type", typ) # Set average filter type: none, scalar or advanced
     def current_average_tcontrol(self, tcontrol):
-        self.keithley6517.write('current:average:tcontrol {}'.format(tcontrol)) # Set average filter type: moving or repeat
-        time.sleep(self.sleep) # Wait
+        self.write_command("current_average_tcontrol", tcontrol) # Set average filter type: moving or repeat
     def current_average_count(self, count):
-        self.keithley6517.write('current:average:count {}'.format(count)) # Set average filter window: 1-100
-        time.sleep(self.sleep) # Wait
+        self.write_command("current_average_count", count) # Set average filter window: 1-100
     def voltage_average_state(self, state):
-        self.keithley6517.write('voltage:average:state {}'.format(state)) #Switch ON or OFF the filter
-        time.sleep(self.sleep) # Wait
+        self.write_command("voltage_average_state", state) #Switch ON or OFF the filter
     def voltage_average_type(self, typ):
-        self.keithley6517.write('voltage:average:type {}'.format(typ)) # Set average filter type: none, scalar or advanced
-        time.sleep(self.sleep) # Wait
+        self.write_command("voltage_average_type", typ) # Set average filter type: none, scalar or advanced
     def voltage_average_tcontrol(self, tcontrol):
-        self.keithley6517.write('voltage:average:tcontrol {}'.format(tcontrol)) # Set average filter type: moving or repeat
-        time.sleep(self.sleep) # Wait
+        self.write_command("voltage_average_tcontrol", tcontrol) # Set average filter type: moving or repeat
     def voltage_average_count(self, count):
-        self.keithley6517.write('voltage:average:count {}'.format(count)) # Set average filter window: 1-100
-        time.sleep(self.sleep) # Wait
+        self.write_command("voltage_average_count", count) # Set average filter window: 1-100
 
     # Median filter
     def current_median_state(self, state):
-        self.keithley6517.write('current:median:state {}'.format(state)) #Switch ON or OFF the filter
-        time.sleep(self.sleep) # Wait
+        self.write_command("current_median_state", state) #Switch ON or OFF the filter
     def current_median_rank(self, rank):
-        self.keithley6517.write('current:median:rank {}'.format(rank)) # Set average filter type: none, scalar or advanced
-        time.sleep(self.sleep) # Wait
+        self.write_command("current_median_rank", rank) # Set average filter type: none, scalar or advanced
     def voltage_median_state(self, state):
-        self.keithley6517.write('voltage:median:state {}'.format(state)) #Switch ON or OFF the filter
-        time.sleep(self.sleep) # Wait
+        self.write_command("voltage_median_state", state) #Switch ON or OFF the filter
     def voltage_median_rank(self, rank):
-        self.keithley6517.write('voltage:median:rank {}'.format(rank)) # Set average filter type: none, scalar or advanced
-        time.sleep(self.sleep) # Wait
+        self.write_command("voltage_median_rank", rank) # Set average filter type: none, scalar or advanced
 
     # Resolution
     def current_digits(self, digits):
-        self.keithley6517.write('current:digits {}'.format(digits)) # Specify n of digits shown from 4 to 7
-        time.sleep(self.sleep) # Wait
+        self.write_command("current_digits", digits) # Specify n of digits shown from 4 to 7
     def voltage_digits(self, digits):
-        self.keithley6517.write('voltage:digits {}'.format(digits)) # Specify n of digits shown from 4 to 7
-        time.sleep(self.sleep) # Wait
+        self.write_command("voltage_digits", digits) # Specify n of digits shown from 4 to 7
 
     # Configure timestamp
     def system_tstamp_type(self, typ = "relative"):
-        self.keithley6517.write('system:tstamp:type {}'.format(typ))
-        time.sleep(self.sleep) # Wait
+        self.write_command("system_tstamp_type", typ)
     def system_tstamp_relative_reset(self):
-        self.keithley6517.write('system:tstamp:relative:reset') # Reset timestamp
-        time.sleep(self.sleep) # Wait
+        self.write_command("system_tstamp_relative_reset") # Reset timestamp
     def system_tstamp_format(self, typ = "absolute"):
-        self.keithley6517.write('data:tstamp:format {}'.format(typ)) # Relative timestamp set to absolute
-        time.sleep(self.sleep) # Wait
+        self.write_command("system_tstamp_format", typ) # Relative timestamp set to absolute
     def buffer_format_tstamp(self, typ = "absolute"): #READing,TSTamp, ETEMperature and VSOurce
-        self.keithley6517.write('trace:tstamp:format {}'.format(typ))
-        time.sleep(self.sleep) # Wait
+        self.write_command("buffer_format_tstamp", typ)
 
     # External temperature reading via K-type thermocouple connected to the back of the device
     def system_tscontrol(self, state):
-        self.keithley6517.write('system:tscontrol {}'.format(state))
+        self.write_command("system_tscontrol", state)
 
     # Data format
     def format_elements(self, elements = "tstamp, reading, vsource"): #READing,TSTamp, ETEMperature and VSOurce
-        self.keithley6517.write('format:elements {}'.format(elements))
-        time.sleep(self.sleep) # Wait
+        self.write_command("format_elements", elements)
+        self.n_elements = len(elements.split(","))
+    def format_data(self, fmt = "ascii"): # ASCii, REAL,32 or SREal (4 bytes), REAL,64 or DREal (8 bytes)
+        self.write_command("format_data", fmt)
+        self.data_format = fmt.replace(" ", "").lower()
+    def format_border(self, order = "swapped"): # Byte order of binary data: normal (big endian) or swapped (little endian)
+        self.write_command("format_border", order)
+        self.byte_order = order.lower()
     def buffer_format_elements(self, elements = "tstamp, vsource"): #READing,TSTamp, ETEMperature and VSOurce
-        self.keithley6517.write('trace:elements {}'.format(elements))
-        time.sleep(self.sleep) # Wait
+        self.write_command("buffer_format_elements", elements)
 
     # Buffer set-up
     def trigger_count(self, count):
-        self.keithley6517.write('trigger:count {}'.format(count)) # Set measure count 1-99999
-        time.sleep(self.sleep) # Wait
+        self.write_command("trigger_count", count) # Set measure count 1-99999
     def trigger_delay(self, delay):
-        self.keithley6517.write('trigger:delay {}'.format(delay)) # Set delay between measurements
-        time.sleep(self.sleep) # Wait
+        self.write_command("trigger_delay", delay) # Set delay between measurements
     def trace_clear(self):
-        self.keithley6517.write('trace:clear') # Clear readings from buffer
-        time.sleep(self.sleep) # Wait
+        self.write_command("trace_clear") # Clear readings from buffer
     def trace_points(self, points):
-        self.keithley6517.write('trace:points {}'.format(points)) # Specify size of buffer (maximum is 8566)
-        time.sleep(self.sleep) # Wait
+        self.write_command("trace_points", points) # Specify size of buffer (maximum is 8566)
     def trace_feed_control(self, control = "next"):
-        self.keithley6517.write('trace:feed:control {}'.format(control)) # Select buffer control mode
-        time.sleep(self.sleep) # Wait
+        self.write_command("trace_feed_control", control) # Select buffer control mode
+    def trace_feed(self, source = "sense"):
+        self.write_command("trace_feed", source) # Select the readings stored in the buffer: sense, calculate or none
+    def trigger_source(self, source = "immediate"):
+        self.write_command("trigger_source", source) # Select the measure event: immediate, timer, manual, bus...
+    def trigger_timer(self, interval):
+        self.write_command("trigger_timer", interval) # Set timer interval in seconds (0.001-99999.999)
+    def abort(self):
+        self.write_command("abort") # Abort the current measurement and return to idle
 
     # Reset
     def reset(self):
-        self.keithley6517.write('*RST') # Reset device
+        self.write_command("reset") # Reset device
+        self.shadow.invalidate() # Setpoints are back to their defaults
+        self.data_format, self.byte_order = "ascii", "normal" # And so is the data format
     def clear_reg(self):
-        self.keithley6517.write('*CLS') # Clear registers
+        self.write_command("clear_reg") # Clear registers
 
     #Start measurement
     def initate_measurement(self):
-        self.keithley6517.write('initiate; *WAI') # Initiate reading, save into buffer and wait until finished
-        time.sleep(self.sleep) # Wait
+        self.write_command("initate_measurement") # Initiate reading, save into buffer and wait until finished
+    def initiate(self):
+        self.write_command("initiate") # Initiate reading without blocking the command parser
 
     # Query data
+    def status_queue_drain(self, header, max_messages = 100):
+        # Read the error queue until it is empty and fail if it held any error
+        errors = []
+        for _ in range(max_messages):
+            reading = self.keithley6517.query('status:queue:next?').replace("\n", "")
+            if reading.strip().startswith("0") or "No Error" in reading:
+                break
+            errors.append(reading)
+        msg = "{} error in:    {}".format("; ".join(errors) if errors else "No Error", header)
+        print(msg)
+        assert not errors, "Setup error of Keithley6517: " + msg
     def status_queue_next(self, header):
         reading = self.keithley6517.query('status:queue:next?') # Read the most recent error messsage.
         time.sleep(self.sleep) # Wait
         msg = "{} error in:    {}".format(reading.replace("\n", ""), header)
         print(msg)
         assert "No Error" in msg, "Setup error of Keithley6517: " + msg
-    def read_latest(self):
-        reading = self.keithley6517.query('read?') # Initialize and return latest reading
-        return list(np.fromstring(reading, sep=','))
-    def get_latest(self):
-        reading = self.keithley6517.query('fetch?') # Initialize and return latest reading
-        return list(np.fromstring(reading, sep=','))
-    def measure(self):
-        reading = self.keithley6517.query('measure?') # Initialize and return latest reading
-        return list(np.fromstring(reading, sep=','))
-    def read_buffer(self, n_columns):
-        reading = self.keithley6517.query('trace:data?') # Read all readings stored in the buffer
-        time.sleep(self.sleep) # Wait
-        # return reading
-        return np.fromstring(reading, sep=',').reshape(-1, n_columns)
+    def read_latest(self, out = None):
+        return self._query_values('read?', out) # Initialize and return latest reading
+    def get_latest(self, out = None):
+        return self._query_values('fetch?', out) # Return latest reading without triggering a new one
+    def measure(self, out = None):
+        return self._query_values('measure?', out) # Configure, initialize and return a reading
+    def read_buffer(self, n_columns, out = None, rows = None, start = None):
+        # Read all readings stored in the buffer, or with start the rows readings from
+        # buffer location start on (0 is the first). In binary formats the number of rows
+        # must be known beforehand; it is queried from the instrument if not given.
+        if self.data_format != "ascii" and rows is None:
+            rows = self.buffer_points_actual() - (start or 0)
+        count = None if rows is None else rows*n_columns
+        command = 'trace:data?' if start is None else 'trace:data:selected? {},{}'.format(start, rows)
+        reading = self._query_values(command, None if out is None else out[:rows].reshape(-1), count)
+        time.sleep(self.sleep) # Wait
+        if out is None:
+            return np.asarray(reading, dtype = float).reshape(-1, n_columns)
+        return out[:len(reading)//n_columns]
+
+    def buffer_points_actual(self):
+        reading = self.keithley6517.query('trace:points:actual?') # Number of readings stored in the buffer
+        return int(float(reading))
     def buffer_status(self):
         buffer_status = self.keithley6517.query('trace:free?') # Return buffer memory status
-        return np.fromstring(buffer_status, sep=',')
+        return np.array(self._parse_ascii(buffer_status))
     def status_measurement_event(self):
         print(self.keithley6517.query('status:measurement:event?'))
         time.sleep(self.sleep) # Wait
@@ -222,3 +328,34 @@ class KEITHLEY6517:
         self.keithley6517.timeout = delay # Remove pyVISA timeout because data reading and transfer is slow (especially the buffer).
         time.sleep(self.sleep) # Wait
 
+    # Reading parsers
+    def _query_values(self, command, out = None, count = None):
+        # Without out a new list is returned, otherwise the values are decoded
+        # into out and the filled part of out is returned.
+        if self.data_format == "ascii":
+            values = self._parse_ascii(self.keithley6517.query(command))
+            if out is None:
+                return values
+            out[:len(values)] = values
+            return out[:len(values)]
+        count = count if count is not None else self.n_elements
+        assert count is not None, "Set format_elements before reading binary data"
+        values = self._read_binary(command, count)
+        if out is None:
+            return values.tolist()
+        out[:count] = values
+        return out[:count]
+    def _parse_ascii(self, reading):
+        # Strip the unit suffixes (e.g. NADC, secs) that the electrometer may append
+        return [float(value.strip().rstrip(string.ascii_letters + "#")) for value in reading.split(',') if value.strip()]
+    def _binary_dtype(self):
+        size = 8 if self.data_format in ("real,64", "dreal") else 4
+        return np.dtype("{}f{}".format("<" if self.byte_order.startswith("swap") else ">", size))
+    def _read_binary(self, command, count):
+        # Binary block: '#0' header, count IEEE754 values and the termination character.
+        # The data may contain the termination byte, so an exact byte count is read.
+        dtype = self._binary_dtype()
+        self.keithley6517.write(command)
+        raw = self.keithley6517.read_bytes(2 + count*dtype.itemsize + len(self.keithley6517.read_termination))
+        assert raw[:2] == b"#0", "Unexpected binary block header from keithley6517: {}".format(raw[:2])
+        return np.frombuffer(raw, dtype = dtype, count = count, offset = 2)
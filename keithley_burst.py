@@ -0,0 +1,135 @@
+# ============================================================================
+# Name        : keithley_burst.py
+# Version     : 1.0.0
+# Description : Hardware-buffered burst acquisition for the KEITHLEY6517.
+#               The electrometer samples into its internal buffer on its own
+#               trigger timer, up to buffer_points readings per arm. While it
+#               keeps sampling, the readings stored since the last transfer
+#               are read every poll_interval (at most block_size at a time)
+#               with trace:data:selected?, so the instrument is only idle when
+#               a full buffer is re-armed and the shared cache is never older
+#               than one transfer. The readings are decoded straight into two
+#               preallocated host blocks used alternately.
+# ============================================================================
+
+import queue
+import time
+import numpy as np
+
+from instrument_pollers import InstrumentPoller
+
+
+class BurstAcquisition(InstrumentPoller):
+    # Drop-in replacement for KeithleyPoller: next_reading() returns one row
+    # at a time, but the rows arrive from the instrument block by block.
+    def __init__(self, k, cache, block_size = 100, interval = 0.05, buffer_points = 8566,
+                 elements = "tstamp, etemperature, vsource", n_columns = 4, poll_interval = 0.05, tstamp_column = 1):
+        InstrumentPoller.__init__(self, "KEITHLEY6517", cache, {})
+        assert 2 <= buffer_points <= 8566, "The 6517 buffer holds 2 to 8566 readings"
+        self.k = k
+        self.block_size = block_size # Most readings per transfer
+        self.interval = interval # Sample interval set on the trigger timer in seconds
+        self.buffer_points = buffer_points # Readings per arm of the instrument buffer
+        self.elements = elements
+        self.n_columns = n_columns # Reading plus the elements stored in the buffer
+        self.poll_interval = poll_interval
+        self.tstamp_column = tstamp_column
+        self.blocks_read = 0
+        self.rearms = 0
+        self._free = queue.Queue()
+        self._filled = queue.Queue()
+        for _ in range(2):
+            self._free.put(np.empty((block_size, n_columns)))
+        self._block = None
+        self._row = 0
+        self._armed = False
+        self._points_read = 0 # Readings of the current arm already transferred
+        self._first_arm = None # Host time of the first arm and first time stamp of its buffer
+        self._first_tstamp = None
+        self._arm_time = None
+        self._tstamp_offset = 0.0
+        self._last_tstamp = None
+
+    def configure(self):
+        # Must be called before start(), while no other thread talks to the instrument
+        self.k.buffer_format_elements(self.elements)
+        self.k.buffer_format_tstamp("absolute")
+        self.k.trace_points(self.buffer_points)
+        self.k.trace_feed("sense")
+        self.k.trigger_source("timer")
+        self.k.trigger_timer(self.interval)
+        self.k.trigger_count(self.buffer_points)
+
+    def arm(self):
+        self.k.trace_clear()
+        self.k.trace_feed_control("next")
+        self.k.initiate()
+        self._arm_time = time.perf_counter()
+        if self._first_arm is None:
+            self._first_arm = self._arm_time
+        else:
+            self.rearms += 1
+        self._points_read = 0
+        self._armed = True
+
+    def _continue_tstamps(self, block, rows):
+        # Absolute time stamps refer to the first reading of the buffer, so they restart
+        # after a re-arm. They are continued from the host time of the arm.
+        tstamps = block[:rows, self.tstamp_column]
+        if self._first_tstamp is None:
+            self._first_tstamp = tstamps[0]
+        if self._points_read == 0 and self._last_tstamp is not None and tstamps[0] + self._tstamp_offset <= self._last_tstamp:
+            self._tstamp_offset = self._first_tstamp + self._arm_time - self._first_arm
+        tstamps += self._tstamp_offset
+        self._last_tstamp = tstamps[-1]
+
+    def poll(self):
+        if not self._armed:
+            self.arm()
+        # Wait for readings not transferred yet
+        while True:
+            pending = min(self.k.buffer_points_actual() - self._points_read, self.block_size)
+            if pending > 0:
+                break
+            if self._stop_event.wait(self.poll_interval):
+                return
+        while True:
+            try:
+                block = self._free.get(timeout = self.poll_interval)
+                break
+            except queue.Empty:
+                if self._stop_event.is_set():
+                    return
+        try:
+            data = self.k.read_buffer(self.n_columns, out = block, rows = pending, start = self._points_read)
+        except Exception as e:
+            self.errors += 1
+            print("{}: buffer transfer failed: {}".format(self.name, e))
+            self._free.put(block)
+            self._armed = False
+            return
+        rows = len(data)
+        self._continue_tstamps(block, rows)
+        self._points_read += rows
+        if self._points_read >= self.buffer_points:
+            self.arm() # The buffer is full, the instrument is idle until here
+        self.blocks_read += 1
+        self.cache.update(keithley = block[rows - 1].tolist())
+        self._filled.put((block, rows))
+        if rows < self.block_size:
+            self._stop_event.wait(self.poll_interval) # Let readings accumulate
+
+    def stop(self, timeout = 5):
+        InstrumentPoller.stop(self, timeout)
+        self.k.abort()
+
+    def next_reading(self, timeout = None):
+        if self._block is None or self._row >= self._rows:
+            if self._block is not None:
+                self._free.put(self._block) # Hand the consumed block back to the acquisition thread
+                self._block = None
+            self._block, self._rows = self._filled.get(timeout = timeout)
+            self._row = 0
+        reading = self._block[self._row].tolist()
+        self._row += 1
+        return reading
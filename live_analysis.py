@@ -0,0 +1,99 @@
+# ============================================================================
+# Name        : live_analysis.py
+# Version     : 1.0.0
+# Description : Incremental version of data_postprocessing.analyze() that runs
+#               during the acquisition. Rows are decimated to points_p_period
+#               points per temperature period as they arrive, and as soon as a
+#               full window is available around a decimated point its phase,
+#               current amplitude and p_coeff are computed and appended to a
+#               side file. Only the last window of points is kept, so the work
+#               per new sample does not grow with the length of the run.
+# ============================================================================
+
+import collections
+import os
+import time
+
+from data_postprocessing import analyze_window
+from run_writer import RunWriter
+
+LIVE_COLUMNS = ["time", "temperature", "current", "phase", "amplitude", "p_coeff", "temp_amplitude"]
+
+
+class IncrementalAnalyzer:
+    # Rows are laid out as the run file (current, time, ext_temp, ...), the indices
+    # can be changed for other layouts. The output units are those of analyze():
+    # nA for current and amplitude, uC/K/m2 for p_coeff.
+    def __init__(self, path, electrode_area, points_p_period = 10, freq = 0.01, window = 51,
+                 engine = "leastsq", current_index = 0, time_index = 1, temp_index = 2, verbose = True):
+        assert window % 2 == 1
+        self.electrode_area = electrode_area
+        self.freq = freq
+        self.engine = engine # Amplitude fit, see data_postprocessing.analyze()
+        self.margin = int((window - 1)/2)
+        self.sample_period = 1/(freq*points_p_period) # Time between decimated points
+        self.current_index = current_index
+        self.time_index = time_index
+        self.temp_index = temp_index
+        self.verbose = verbose
+        # The analyze() window of point i covers i-margin up to i+margin-1, and point i is
+        # only analyzed once i+margin has arrived
+        self.points = collections.deque(maxlen = 2*self.margin + 1)
+        self.next_time = None
+        self.rows_seen = 0
+        self.windows = 0
+        self.errors = 0
+        self.analysis_time = 0 # Total time spent analyzing windows in seconds
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.writer = RunWriter(path, flush_rows = 1, flush_interval = 0, fsync = "never")
+        if new_file:
+            self.writer.write_row(LIVE_COLUMNS)
+
+    def __call__(self, row):
+        self.add(row)
+
+    def add(self, row):
+        # Feed one acquired row, returns the analyzed window if one was completed
+        self.rows_seen += 1
+        t = row[self.time_index]
+        if self.next_time is not None and t < self.next_time:
+            return None
+        self.next_time = t + self.sample_period if self.next_time is None else self.next_time + self.sample_period
+        if self.next_time <= t: # Catch up after a gap in the data
+            self.next_time = t + self.sample_period
+        self.points.append((t, row[self.temp_index], row[self.current_index]))
+        if len(self.points) < self.points.maxlen:
+            return None
+        return self._analyze()
+
+    def _analyze(self):
+        start = time.perf_counter()
+        points = list(self.points)[:-1]
+        tim = [p[0] for p in points]
+        Ax = [p[1] for p in points]
+        Bx = [p[2] for p in points]
+        ti, temp, current = points[self.margin]
+        try:
+            phase, current_amplitude, p_coeff, temp_amplitude = analyze_window(tim, Ax, Bx, self.electrode_area,
+                                                                               frequency = self.freq, engine = self.engine)
+        except Exception as e:
+            self.errors += 1
+            print("Live analysis of window at {} s failed: {}".format(ti, e))
+            return None
+        result = [round(ti, 3), temp, current*1e9, round(phase, 3), current_amplitude*1e9,
+                  p_coeff*1e6, temp_amplitude]
+        self.writer.write_row(result)
+        self.windows += 1
+        self.analysis_time += time.perf_counter() - start
+        if self.verbose:
+            print("Live analysis: time {} s  phase {} deg  amplitude {:.4g} nA  p_coeff {:.4g} uC/K/m2".format(
+                result[0], result[3], result[4], result[5]))
+        return result
+
+    def close(self):
+        self.writer.close()
+
+    def report(self):
+        mean = self.analysis_time/self.windows*1000 if self.windows else 0
+        return "Live analysis: {} rows, {} windows analyzed ({} ms per window), {} errors".format(
+            self.rows_seen, self.windows, round(mean, 3), self.errors)
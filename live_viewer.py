@@ -0,0 +1,74 @@
+# ============================================================================
+# Name        : live_viewer.py
+# Version     : 1.0.0
+# Description : Plots the readings of a running measurement in a separate
+#               process. The rows are taken from the shared-memory ring that
+#               the acquisition loop publishes to, so the viewer never slows
+#               down the measurement; rows lost because the viewer fell behind
+#               are counted in the title.
+#               Example: python live_viewer.py --span 600
+# ============================================================================
+
+import argparse
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.animation import FuncAnimation
+
+from reading_ring import RingReader, DEFAULT_NAME
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Live plot of the readings of a running measurement.")
+    parser.add_argument("--name", default = DEFAULT_NAME, help = "Name of the shared-memory ring")
+    parser.add_argument("--span", type = float, default = 600, help = "Seconds of data shown")
+    parser.add_argument("--interval", type = float, default = 0.5, help = "Refresh interval in seconds")
+    parser.add_argument("--print", action = "store_true", help = "Also print every new row")
+    args = parser.parse_args()
+
+    reader = RingReader(args.name)
+    columns = reader.columns
+    t_index = columns.index("time")
+    data = np.empty((0, len(columns)))
+
+    fig, axs = plt.subplots(2, figsize = (10, 6), sharex = True)
+    ax0, ax1, ax2 = axs[0], axs[0].twinx(), axs[1]
+    temp_line, = ax0.plot([], [], color = "blue", label = "ext_temp")
+    target_line, = ax0.plot([], [], color = "gray", linestyle = "--", label = "new_target_temp")
+    scale = 1e9 if columns[0] == "current" else 1 # First column is the Keithley reading
+    current_line, = ax1.plot([], [], color = "red", label = columns[0])
+    volt_line, = ax2.plot([], [], color = "green", label = "pid_out_volt")
+    ax0.set_ylabel('Temperature (°C)')
+    ax1.set_ylabel('Current (nA)' if columns[0] == "current" else columns[0].capitalize())
+    ax2.set_ylabel('Peltier voltage (V)')
+    ax2.set_xlabel('Time (s)')
+
+    def update(frame):
+        nonlocal data
+        rows, lost = reader.read()
+        if args.print:
+            for row in rows:
+                print(row.tolist())
+        if len(rows):
+            data = np.concatenate([data, rows])
+            data = data[data[:, t_index] >= data[-1, t_index] - args.span]
+        if len(data) == 0:
+            return
+        t = data[:, t_index]
+        temp_line.set_data(t, data[:, columns.index("ext_temp")])
+        target_line.set_data(t, data[:, columns.index("new_target_temp")])
+        current_line.set_data(t, data[:, 0]*scale)
+        volt_line.set_data(t, data[:, columns.index("pid_out_volt")])
+        for ax in (ax0, ax1, ax2):
+            ax.relim()
+            ax.autoscale_view()
+        status = " (measurement finished)" if reader.closed else ""
+        fig.suptitle("{} rows, {} lost in {} overruns{}".format(reader.rows_read, reader.rows_lost,
+                                                                reader.overruns, status))
+
+    animation = FuncAnimation(fig, update, interval = args.interval*1000, cache_frame_data = False)
+    plt.show()
+    reader.close()
+
+
+if __name__ == "__main__":
+    main()
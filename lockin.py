@@ -0,0 +1,191 @@
+# ============================================================================
+# Name        : lockin.py
+# Version     : 1.0.0
+# Description : Digital lock-in demodulation of the temperature and current at
+#               the known temperature frequency. Each signal has its offset and
+#               slope removed by a zero-lag double exponential average, is then
+#               multiplied by sine and cosine references and low-pass filtered
+#               by a cascade of exponential averages with time constant tau.
+#               The averages use exp(-dt/tau) for every sample, so irregular
+#               sample intervals are filtered exactly.
+#
+#               LockIn works sample by sample during the acquisition and
+#               lockin_analyze() gives the same values for a recorded run in a
+#               few vectorized passes. LockInAnalyzer is an acquisition loop
+#               consumer that writes the lock-in output to a side file.
+# ============================================================================
+
+import math
+import os
+import numpy as np
+import pandas as pd
+
+from data_postprocessing import p_coefficient
+from run_writer import RunWriter
+
+LOCKIN_COLUMNS = ["time", "temperature", "current", "phase", "amplitude", "p_coeff", "temp_amplitude"]
+MAX_BLOCK_DECAY = 300 # Time constants per block of the vectorized average, keeps exp() finite
+
+
+def ema(x, t, tau, initial = None):
+    # Exponential moving average of x sampled at the times t, starting from initial
+    # (default x[0]): y[k] = d[k]*y[k-1] + (1 - d[k])*x[k] with d[k] = exp(-(t[k]-t[k-1])/tau)
+    x = np.asarray(x, dtype = float)
+    t = np.asarray(t, dtype = float)
+    out = np.empty(len(x))
+    if len(x) == 0:
+        return out
+    previous = x[0] if initial is None else initial
+    previous_time = t[0]
+    start = 0
+    while start < len(x):
+        # Within a block y[k] = exp(-L[k])*(y0 + cumsum((1 - d)*x*exp(L))) with L the decay since the block start
+        decay = (t[start:] - previous_time)/tau
+        stop = start + max(1, np.searchsorted(decay, MAX_BLOCK_DECAY, side = "right"))
+        decay = decay[:stop - start]
+        steps = np.diff(np.concatenate([[0], decay]))
+        weights = -np.expm1(-steps)*np.exp(decay)
+        out[start:stop] = np.exp(-decay)*(previous + np.cumsum(weights*x[start:stop]))
+        previous = out[stop - 1]
+        previous_time = t[stop - 1]
+        start = stop
+    return out
+
+
+def baseline_gain(freq, tau):
+    # Magnitude of the response at freq left after subtracting the double exponential
+    # average, |1 - (2H - H^2)| = |1 - H|^2 with H = 1/(1 + j*2*pi*freq*tau)
+    wt = 2*math.pi*freq*tau
+    return wt**2/(1 + wt**2)
+
+
+class LockIn:
+    # Streaming demodulator. update() takes one sample and returns phase (deg),
+    # current amplitude and temperature amplitude, the values are only reliable
+    # once settled is True. The phase follows analyze(): temperature minus current.
+    def __init__(self, freq, tau = None, order = 3, settle_time = None):
+        self.freq = freq
+        self.tau = tau if tau is not None else 1/freq
+        self.order = order
+        self.settle_time = settle_time if settle_time is not None else 10*self.tau
+        self.gain = baseline_gain(freq, self.tau)
+        self.start_time = None
+        self.last_time = None
+        self.base = None # [E1, E2] per signal
+        self.lowpass = None # order stages of [in-phase, quadrature] per signal
+
+    @property
+    def settled(self):
+        return self.last_time is not None and self.last_time - self.start_time >= self.settle_time
+
+    def update(self, t, temp, current):
+        signals = (temp, current)
+        if self.start_time is None:
+            self.start_time = self.last_time = t
+            self.base = [[y, y] for y in signals]
+            self.lowpass = [[[0.0, 0.0] for stage in range(self.order)] for y in signals]
+        d = math.exp(-(t - self.last_time)/self.tau)
+        self.last_time = t
+        reference = (math.sin(2*math.pi*self.freq*t), math.cos(2*math.pi*self.freq*t))
+        results = []
+        for y, base, stages in zip(signals, self.base, self.lowpass):
+            base[0] = d*base[0] + (1 - d)*y
+            base[1] = d*base[1] + (1 - d)*base[0]
+            z = y - (2*base[0] - base[1])
+            values = [z*reference[0], z*reference[1]]
+            for stage in stages:
+                for j in range(2):
+                    stage[j] = d*stage[j] + (1 - d)*values[j]
+                values = stage
+            results.append((2*math.hypot(values[0], values[1])/self.gain, math.atan2(values[1], values[0])))
+        (temp_amplitude, temp_phase), (current_amplitude, current_phase) = results
+        phase = math.degrees(math.remainder(temp_phase - current_phase, 2*math.pi))
+        return phase, current_amplitude, temp_amplitude
+
+
+def lockin_demodulate(t, temp, current, freq, tau = None, order = 3):
+    # Vectorized LockIn.update() over a whole record, returns phase, current and temperature amplitudes
+    tau = tau if tau is not None else 1/freq
+    t = np.asarray(t, dtype = float)
+    reference = (np.sin(2*np.pi*freq*t), np.cos(2*np.pi*freq*t))
+    results = []
+    for y in (np.asarray(temp, dtype = float), np.asarray(current, dtype = float)):
+        e1 = ema(y, t, tau)
+        e2 = ema(e1, t, tau, initial = y[0])
+        z = y - (2*e1 - e2)
+        values = [z*reference[0], z*reference[1]]
+        for stage in range(order):
+            values = [ema(v, t, tau, initial = 0.0) for v in values]
+        results.append((2*np.hypot(values[0], values[1])/baseline_gain(freq, tau), np.arctan2(values[1], values[0])))
+    (temp_amplitude, temp_phase), (current_amplitude, current_phase) = results
+    phase = np.degrees(np.remainder(temp_phase - current_phase + np.pi, 2*np.pi) - np.pi)
+    return phase, current_amplitude, temp_amplitude
+
+
+def lockin_analyze(df, electrode_area, freq = 0.01, tau = None, order = 3, settle_time = None):
+    # Per-sample lock-in analysis of a recorded run, same columns and units as analyze()
+    # but without decimation. The first settle_time seconds (default 10*tau) are dropped.
+    print("lock-in analysis...")
+    tau = tau if tau is not None else 1/freq
+    settle_time = settle_time if settle_time is not None else 10*tau
+    t = np.array(df["time"], dtype = float)
+    temp = np.array(df["ext_temp"], dtype = float)
+    current = np.array(df["current"], dtype = float)
+    phase, current_amplitude, temp_amplitude = lockin_demodulate(t, temp, current, freq, tau, order)
+    out = pd.DataFrame({"time": t,
+                        "temperature": temp,
+                        "current": current*1e9,
+                        "phase": phase,
+                        "amplitude": current_amplitude*1e9,
+                        "p_coeff": p_coefficient(phase, current_amplitude, temp_amplitude, electrode_area, freq)*1e6,
+                        "temp_amplitude": temp_amplitude})
+    return out[t - t[0] >= settle_time].reset_index(drop = True)
+
+
+class LockInAnalyzer:
+    # Acquisition loop consumer, demodulates every row and appends one row of lock-in
+    # output per output_period seconds to the side file once the filters have settled.
+    def __init__(self, path, electrode_area, freq = 0.01, tau = None, order = 3, output_period = None,
+                 current_index = 0, time_index = 1, temp_index = 2, verbose = False):
+        self.lockin = LockIn(freq, tau, order)
+        self.electrode_area = electrode_area
+        self.freq = freq
+        self.output_period = output_period if output_period is not None else 1/(10*freq)
+        self.current_index = current_index
+        self.time_index = time_index
+        self.temp_index = temp_index
+        self.verbose = verbose
+        self.next_output = None
+        self.rows_seen = 0
+        self.rows_written = 0
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.writer = RunWriter(path, flush_rows = 1, flush_interval = 0, fsync = "never")
+        if new_file:
+            self.writer.write_row(LOCKIN_COLUMNS)
+
+    def __call__(self, row):
+        self.add(row)
+
+    def add(self, row):
+        self.rows_seen += 1
+        t = row[self.time_index]
+        temp = row[self.temp_index]
+        current = row[self.current_index]
+        phase, current_amplitude, temp_amplitude = self.lockin.update(t, temp, current)
+        if not self.lockin.settled or (self.next_output is not None and t < self.next_output):
+            return None
+        self.next_output = t + self.output_period
+        p_coeff = p_coefficient(phase, current_amplitude, temp_amplitude, self.electrode_area, self.freq)
+        result = [round(t, 3), temp, current*1e9, round(phase, 3), current_amplitude*1e9, p_coeff*1e6, temp_amplitude]
+        self.writer.write_row(result)
+        self.rows_written += 1
+        if self.verbose:
+            print("Lock-in: time {} s  phase {} deg  amplitude {:.4g} nA  p_coeff {:.4g} uC/K/m2".format(
+                result[0], result[3], result[4], result[5]))
+        return result
+
+    def close(self):
+        self.writer.close()
+
+    def report(self):
+        return "Lock-in: {} rows demodulated, {} rows written".format(self.rows_seen, self.rows_written)
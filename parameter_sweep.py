@@ -0,0 +1,117 @@
+# ============================================================================
+# Name        : parameter_sweep.py
+# Version     : 1.0.0
+# Description : Runs analyze() for a grid of window, points_p_period and
+#               decimation values on one run and returns a table with the
+#               p_coeff and phase statistics of every configuration. Each
+#               decimation is computed once and shared in shared memory by all
+#               windows that use it, and the configurations run in parallel on
+#               a process pool. The rows of every configuration are the rows
+#               analyze() returns for it.
+#               Example: python parameter_sweep.py run.csv --window 31 51 101
+# ============================================================================
+
+import argparse
+import itertools
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+
+from data_postprocessing import decimate, analyze_shared
+from run_format import load_run
+
+SWEEP_COLUMNS = ["points_p_period", "decimation", "window", "points", "p_coeff_mean", "p_coeff_median", "p_coeff_std",
+                 "phase_mean", "phase_median", "phase_std", "amplitude_mean", "temp_amplitude_mean", "decimation_s"]
+
+
+def summarize_configuration(rows, points_p_period, decimation, window, decimation_s):
+    # Statistics of the rows of one configuration, in the units of analyze()
+    out = pd.DataFrame(rows, columns = ["time", "temperature", "current", "phase", "amplitude", "p_coeff", "temp_amplitude"])
+    p_coeff = out["p_coeff"]*1e6
+    return {"points_p_period": points_p_period,
+            "decimation": decimation,
+            "window": window,
+            "points": len(out),
+            "p_coeff_mean": p_coeff.mean(),
+            "p_coeff_median": p_coeff.median(),
+            "p_coeff_std": p_coeff.std(),
+            "phase_mean": out["phase"].mean(),
+            "phase_median": out["phase"].median(),
+            "phase_std": out["phase"].std(),
+            "amplitude_mean": (out["amplitude"]*1e9).mean(),
+            "temp_amplitude_mean": out["temp_amplitude"].mean(),
+            "decimation_s": decimation_s}
+
+
+def sweep(df, electrode_area, windows = (51,), points_p_periods = (10,), decimations = ("resample",), freq = 0.01,
+          engine = "linear", phase_method = "batched", workers = None):
+    # One row per combination of points_p_period, decimation and window, sorted in that order
+    df = df[["time", "current", "ext_temp"]]
+    segments = []
+    try:
+        decimated = {}
+        for points_p_period, decimation in itertools.product(points_p_periods, decimations):
+            start = time.perf_counter()
+            t, A_values, B_values = decimate(df, points_p_period, freq, decimation)[:3]
+            shm = shared_memory.SharedMemory(create = True, size = max(1, 3*len(t)*8))
+            segments.append(shm)
+            data = np.ndarray((3, len(t)), dtype = np.float64, buffer = shm.buf)
+            data[0], data[1], data[2] = t, A_values, B_values
+            del data
+            decimated[points_p_period, decimation] = (shm.name, len(t), round(time.perf_counter() - start, 3))
+
+        configurations = list(itertools.product(points_p_periods, decimations, windows))
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            futures = []
+            for points_p_period, decimation, window in configurations:
+                assert window % 2 == 1, "The window must be odd"
+                name, n, decimation_s = decimated[points_p_period, decimation]
+                margin = int((window-1)/2)
+                if n <= 2*margin: # Fewer points than one window
+                    futures.append(None)
+                    continue
+                futures.append(pool.submit(analyze_shared, name, n, margin, n-margin, electrode_area, freq, margin,
+                                           engine, phase_method))
+            summary = []
+            for (points_p_period, decimation, window), future in zip(configurations, futures):
+                rows = future.result() if future is not None else np.empty((0, 7))
+                summary.append(summarize_configuration(rows, points_p_period, decimation, window,
+                                                       decimated[points_p_period, decimation][2]))
+        return pd.DataFrame(summary, columns = SWEEP_COLUMNS)
+    finally:
+        for shm in segments:
+            shm.close()
+            shm.unlink()
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Analyze one run for a grid of analysis parameters.")
+    parser.add_argument("run", help = "Run file, .csv or .run")
+    parser.add_argument("--electrode-area", type = float, default = 240e-6, help = "Electrode area in m2")
+    parser.add_argument("--window", type = int, nargs = "+", default = [31, 51, 71, 101], help = "Windows in points, odd")
+    parser.add_argument("--points-p-period", type = int, nargs = "+", default = [10, 20])
+    parser.add_argument("--decimation", choices = ["stride", "resample"], nargs = "+", default = ["stride", "resample"])
+    parser.add_argument("--freq", type = float, default = 0.01, help = "Temperature frequency in Hz")
+    parser.add_argument("--engine", choices = ["leastsq", "linear"], default = "linear")
+    parser.add_argument("--phase-method", choices = ["loop", "batched"], default = "batched")
+    parser.add_argument("--workers", type = int, default = None)
+    parser.add_argument("--output", default = None, help = "Table of the results (.csv or .xlsx)")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    table = sweep(load_run(args.run), args.electrode_area, args.window, args.points_p_period, args.decimation,
+                  args.freq, args.engine, args.phase_method, args.workers)
+    with pd.option_context("display.max_columns", None, "display.width", 200):
+        print(table)
+    print("{} configurations in {:.1f} s".format(len(table), time.perf_counter() - start))
+    if args.output is not None:
+        if args.output.endswith(".xlsx"):
+            table.to_excel(args.output, index = False)
+        else:
+            table.to_csv(args.output, index = False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+# ============================================================================
+# Name        : plot_pyramid.py
+# Version     : 1.0.0
+# Description : Multi-resolution min/max downsample pyramid for plotting long
+#               runs. Level 0 is the data itself, every further level keeps
+#               the minimum and maximum (in time order) of each bucket of
+#               factor buckets of the level below, so peaks are never lost.
+#               For a time range and a plot width the coarsest level with at
+#               least two points per pixel is drawn, and lines drawn with
+#               plot_pyramid() switch level when the axes are zoomed.
+#               Pyramids are stored next to the run or analysis file as
+#               <name>_PYRAMID.npz.
+# ============================================================================
+
+import os
+import numpy as np
+
+from run_format import load_run
+from analysis_io import load_analysis
+
+PYRAMID_SUFFIX = "_PYRAMID.npz"
+
+
+def pyramid_path(path):
+    return os.path.splitext(path)[0] + PYRAMID_SUFFIX
+
+
+def _min_max(x, y, group):
+    # Minimum and maximum of every group of points, in time order, as pairs of points
+    pad = -len(y) % group
+    if pad:
+        x = np.concatenate([x, np.repeat(x[-1:], pad)])
+        y = np.concatenate([y, np.repeat(y[-1:], pad)])
+    x = x.reshape(-1, group)
+    y = y.reshape(-1, group)
+    nan = np.isnan(y)
+    i_min = np.where(nan, np.inf, y).argmin(axis = 1)
+    i_max = np.where(nan, -np.inf, y).argmax(axis = 1)
+    index = np.sort(np.stack([i_min, i_max], axis = 1), axis = 1)
+    return np.take_along_axis(x, index, axis = 1).ravel(), np.take_along_axis(y, index, axis = 1).ravel()
+
+
+class DownsamplePyramid:
+    def __init__(self, arrays, n_levels, factor, time_column = "time"):
+        self.arrays = arrays # "time" and "<column>" for level 0, "<level>/time/<column>" and "<level>/<column>" above
+        self.n_levels = n_levels
+        self.factor = factor
+        self.time_column = time_column
+        self._loaded = {}
+        self.columns = [key for key in self.keys() if "/" not in key and key != time_column]
+
+    @classmethod
+    def build(cls, df, columns = None, time_column = "time", factor = 4, min_points = 1000):
+        # Levels are added until a level has fewer than min_points points
+        t = np.asarray(df[time_column], dtype = float)
+        columns = columns or [column for column in df.columns if column != time_column]
+        arrays = {time_column: t}
+        n_levels = 1
+        for column in columns:
+            x, y = t, np.asarray(df[column], dtype = float)
+            arrays[column] = y
+            level, group = 1, factor
+            while len(y) >= 2*min_points:
+                x, y = _min_max(x, y, group)
+                arrays["{}/time/{}".format(level, column)] = x
+                arrays["{}/{}".format(level, column)] = y
+                level, group = level + 1, 2*factor
+            n_levels = max(n_levels, level)
+        return cls(arrays, n_levels, factor, time_column)
+
+    def save(self, path):
+        np.savez(path, **{key: self[key] for key in self.keys()},
+                 _meta = np.array([self.n_levels, self.factor]), _time_column = np.array(self.time_column))
+        return path
+
+    @classmethod
+    def load(cls, path):
+        # Arrays are read from the file when a level is first used
+        arrays = np.load(path)
+        n_levels, factor = arrays["_meta"]
+        return cls(arrays, int(n_levels), int(factor), str(arrays["_time_column"]))
+
+    def keys(self):
+        keys = self.arrays.files if hasattr(self.arrays, "files") else list(self.arrays)
+        return [key for key in keys if not key.startswith("_")]
+
+    def __getitem__(self, key):
+        if key not in self._loaded:
+            self._loaded[key] = self.arrays[key]
+        return self._loaded[key]
+
+    def level_data(self, column, level):
+        if level == 0:
+            return self[self.time_column], self[column]
+        return self["{}/time/{}".format(level, column)], self["{}/{}".format(level, column)]
+
+    def has_level(self, column, level):
+        return level == 0 or "{}/{}".format(level, column) in self.keys()
+
+    def select(self, column, start_time = None, stop_time = None, n_pixels = 1000):
+        # Points of column between start_time and stop_time from the coarsest level with at
+        # least two points per pixel, plus one point on either side so the line reaches the edges
+        t = self[self.time_column]
+        if len(t) == 0:
+            return t, np.empty(0), 0 # Nothing analyzed, e.g. a run shorter than one window
+        start_time = t[0] if start_time is None else start_time
+        stop_time = t[-1] if stop_time is None else stop_time
+        n_points = np.searchsorted(t, stop_time, side = "right") - np.searchsorted(t, start_time, side = "left")
+        level = 0
+        while self.has_level(column, level + 1) and 2*n_points/(self.factor**(level + 1)) >= 2*n_pixels:
+            level += 1
+        x, y = self.level_data(column, level)
+        first = max(np.searchsorted(x, start_time, side = "left") - 1, 0)
+        last = np.searchsorted(x, stop_time, side = "right") + 1
+        return x[first:last], y[first:last], level
+
+
+def save_pyramid(df, path, columns = None, time_column = "time"):
+    # Pyramid of df stored next to path, the run or analysis file df was written to
+    return DownsamplePyramid.build(df, columns, time_column).save(pyramid_path(path))
+
+
+def load_pyramid(path):
+    # Pyramid of a run or analysis file, built and stored first if missing or older than the file
+    pyramid_file = pyramid_path(path)
+    if not os.path.exists(pyramid_file) or os.path.getmtime(pyramid_file) < os.path.getmtime(path):
+        stem = os.path.splitext(os.path.basename(path))[0]
+        df = load_analysis(path) if stem.endswith("ANALYZED") else load_run(path)
+        save_pyramid(df, path)
+    return DownsamplePyramid.load(pyramid_file)
+
+
+def plot_pyramid(ax, pyramid, column, scale = 1, **kwargs):
+    # Line of column on ax that is redrawn from the matching level whenever the x limits change
+    x, y, level = pyramid.select(column, n_pixels = max(int(ax.bbox.width), 1))
+    line, = ax.plot(x, y*scale, **kwargs)
+
+    def update(ax_changed):
+        start_time, stop_time = ax_changed.get_xlim()
+        x, y, level = pyramid.select(column, start_time, stop_time, max(int(ax.bbox.width), 1))
+        line.set_data(x, y*scale)
+
+    ax.callbacks.connect("xlim_changed", update)
+    return line
@@ -3,33 +3,54 @@ import pandas as pd
 import csv
 
 from data_postprocessing import analyze
+from run_format import load_run
+from analysis_io import save_analysis, export_excel
+from plot_pyramid import save_pyramid, load_pyramid
+from chunked_analysis import analyze_chunked
+from lockin import lockin_analyze
+from analysis_cache import AnalysisCache
 
 
 file_name = "/Users/joaquinllacerwintle/OneDrive - ETH Zurich/data/20220128 (1)/16h03m35s_20000s_joaquim_circular100_poledwithoutelectrodes"
+run_file = '{}.csv'.format(file_name) # or '{}.run' for runs recorded in the binary format
 # Parameters
 electrode_area = 240e-6 # Area of the measuring electrode in m2.
+workers = None # Analysis processes, e.g. os.cpu_count(). None analyzes serially.
+lockin = False # Also write the per-sample lock-in analysis
+analysis_format = "parquet" # "parquet", "feather", "run" or "csv"
+excel_export = False # Also convert the analyzed data to .xlsx
+cache = AnalysisCache("../data/.analysis_cache") # Results of earlier analyses, None to always recompute
+chunked = False # Read and analyze the run in chunks with bounded memory, for runs too long to load (stride decimation)
 
-df = pd.read_csv('{}.csv'.format(file_name), names = ["current",
-                                   "time",
-                                   "ext_temp",
-                                   "int_temp",
-                                   "new_target_temp",
-                                   "pid_out_volt",
-                                   "pelt_volt",
-                                   "pelt_curr",
-                                   "vsource"])
-df = df[["time",
-         "current",
-         "int_temp",
-         "ext_temp",
-         "new_target_temp",
-         "pid_out_volt",
-         "pelt_volt",
-         "pelt_curr",
-         "vsource"]]
+if chunked:
+    # Only the analysis and its pyramid are written, the figure, the run pyramid and the lock-in need the whole run
+    analysis_file = analyze_chunked(run_file, file_name + "REANALYZED", electrode_area = electrode_area, points_p_period = 10, freq = 0.01, window = 51,
+                                    engine = "linear", phase_method = "batched", output_format = analysis_format)
+    if excel_export:
+        export_excel(analysis_file)
+    load_pyramid(analysis_file)
+else:
+    df = load_run(run_file)
+    df = df[["time",
+             "current",
+             "int_temp",
+             "ext_temp",
+             "new_target_temp",
+             "pid_out_volt",
+             "pelt_volt",
+             "pelt_curr",
+             "vsource"]]
 
-print(df.tail(20))
+    print(df.tail(20))
 
-analyzed_data, figure = analyze(df = df, electrode_area = electrode_area, points_p_period = 10, freq = 0.01, window = 51)
-analyzed_data.to_excel('{}.xlsx'.format(file_name + "REANALYZED"))
-figure.savefig('{}.png'.format(file_name + "REANALYZED"))
\ No newline at end of file
+    analyzed_data, figure = analyze(df = df, electrode_area = electrode_area, points_p_period = 10, freq = 0.01, window = 51, engine = "linear", phase_method = "batched", decimation = "resample",
+                                    workers = workers, cache = cache)
+    analysis_file = save_analysis(analyzed_data, file_name + "REANALYZED", analysis_format)
+    if excel_export:
+        export_excel(analysis_file)
+    save_pyramid(df, run_file) # For plotting the run and its analysis at any zoom
+    save_pyramid(analyzed_data, analysis_file)
+    figure.savefig('{}.png'.format(file_name + "REANALYZED"))
+    if lockin:
+        lockin_data = lockin_analyze(df, electrode_area = electrode_area, freq = 0.01)
+        lockin_data.to_csv('{}.csv'.format(file_name + "LOCKIN"), index = False)
@@ -14,16 +14,39 @@ import ntpath
 import seaborn as sns
 sns.set_style("ticks")
 
-fp = "/Users/joaquinllacerwintle/OneDrive - ETH Zurich/data/20211024/15h29m38s_52500s_poled-pvdf-test2ANALYZED.xlsx"
+from data_postprocessing import analyze
+from run_format import load_run
+from analysis_cache import AnalysisCache
+from analysis_io import load_analysis
+from plot_pyramid import DownsamplePyramid, load_pyramid, plot_pyramid
+
+fp = "/Users/joaquinllacerwintle/OneDrive - ETH Zurich/data/20211024/15h29m38s_52500s_poled-pvdf-test2ANALYZED.xlsx" # .parquet, .feather, .run, .csv or .xlsx
+rows = (600, 650) # Rows printed and shown by default, only these rows are read from the columnar formats
+time_range = None # (start, stop) in s to show, None for the time span of rows
+si_units = True # fp holds A and C/K/m2 (older files), False for nA and uC/K/m2
 temp_min = 35
 temp_max = 40
 curr_min = -2
 curr_max = 2
 coef_min = -0
 coef_max = 50
+# Alternatively plot a recorded run (.csv or .run), its analysis is taken from the
+# analysis cache and only computed when the run or the parameters are new
+run_file = None
+electrode_area = 240e-6
 
 
-out = pd.read_excel('{}'.format(fp), engine = "openpyxl")[600:650]
+if run_file is None:
+    out = load_analysis(fp, rows = rows)
+    pyramid = load_pyramid(fp) # Built from fp and stored next to it on first use
+else:
+    fp = os.path.splitext(run_file)[0] + "ANALYZED.xlsx" # Name of the replot figure
+    out, figure = analyze(load_run(run_file), electrode_area = electrode_area, points_p_period = 10, freq = 0.01, window = 51,
+                          engine = "linear", phase_method = "batched", decimation = "resample", cache = AnalysisCache("../data/.analysis_cache"))
+    pyramid = DownsamplePyramid.build(out)
+    out = out[rows[0]:rows[1]]
+    si_units = False
+current_scale, p_scale = (1e9, 1e6) if si_units else (1, 1)
 
 print(out)
 
@@ -31,10 +54,13 @@ print(out)
 fig, axs = plt.subplots(2, figsize=(10,4), sharex=True, sharey=False)
 #fig.suptitle(fp)
 ax0, ax1, ax2, ax3 = axs[0], axs[0].twinx(), axs[1], axs[1].twinx()
-ax0.plot(out["time"], out["temperature"], color = "blue")
-ax1.plot(out["time"], out["current"]*1e9, color = "red")
-ax2.plot(out["time"], out["phase"], color = "black")
-ax3.plot(out["time"], out["p_coeff"]*1e6, color = "green")
+# Drawn from the pyramid level that matches the time range and the width of the axes
+plot_pyramid(ax0, pyramid, "temperature", color = "blue")
+plot_pyramid(ax1, pyramid, "current", scale = current_scale, color = "red")
+plot_pyramid(ax2, pyramid, "phase", color = "black")
+plot_pyramid(ax3, pyramid, "p_coeff", scale = p_scale, color = "green")
+# Without time_range the figure shows the time span of rows
+ax0.set_xlim(time_range if time_range is not None else tuple(out["time"].iloc[[0, -1]]))
 #ax4.plot(out["time"], out["amplitude"], color = "pink")
 ax0.set_yticks(np.linspace(temp_min, temp_max, 9))
 ax1.set_yticks(np.linspace(curr_min, curr_max, 9))
@@ -49,5 +75,5 @@ ax0.yaxis.label.set_color('blue')
 ax1.yaxis.label.set_color('red')
 ax2.yaxis.label.set_color('black')
 ax3.yaxis.label.set_color('green')
-fig.savefig('{}.png'.format(fp[:-5] + "replot"))
+fig.savefig('{}.png'.format(os.path.splitext(fp)[0] + "replot"))
 plt.show()
\ No newline at end of file
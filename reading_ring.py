@@ -0,0 +1,173 @@
+# ============================================================================
+# Name        : reading_ring.py
+# Version     : 1.0.0
+# Description : Fixed-size ring buffer of readings in shared memory. The
+#               acquisition loop publishes every row into it and any number of
+#               local processes (live viewer, logger, analysis worker) read the
+#               rows by sequence number. The producer never waits for the
+#               consumers: a consumer that falls more than one ring behind
+#               detects the overrun and skips the rows it has lost.
+#
+#               Layout: header (magic, published rows, slots, columns, closed),
+#               column names as JSON, sequence number per slot, float64 rows.
+# ============================================================================
+
+import json
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+MAGIC = 0x50595252494E4731 # "PYRRING1"
+HEADER_FIELDS = 8
+NAMES_SIZE = 1024
+DEFAULT_NAME = "pyro_readings"
+
+_created = set() # Segments created by this process
+
+
+def _layout(n_slots, n_columns):
+    header = HEADER_FIELDS*8
+    slot_seq = header + NAMES_SIZE
+    data = slot_seq + n_slots*8
+    return slot_seq, data, data + n_slots*n_columns*8
+
+
+class _Ring:
+    def _map(self, n_slots, n_columns):
+        slot_seq, data, size = _layout(n_slots, n_columns)
+        buf = self.shm.buf
+        self.header = np.ndarray(HEADER_FIELDS, dtype = np.int64, buffer = buf)
+        self.slot_seq = np.ndarray(n_slots, dtype = np.int64, buffer = buf, offset = slot_seq)
+        self.data = np.ndarray((n_slots, n_columns), dtype = np.float64, buffer = buf, offset = data)
+        self.n_slots = n_slots
+        self.n_columns = n_columns
+
+    def _release(self):
+        # The numpy views must be gone before the segment can be closed
+        self.header = self.slot_seq = self.data = None
+        self.shm.close()
+
+
+class ReadingRing(_Ring):
+    # Producer side, owns the shared memory segment
+    def __init__(self, columns, n_slots = 65536, name = DEFAULT_NAME):
+        self.columns = list(columns)
+        names = json.dumps(self.columns).encode()
+        assert len(names) <= NAMES_SIZE, "Column names do not fit in the ring header"
+        size = _layout(n_slots, len(self.columns))[2]
+        try:
+            self.shm = shared_memory.SharedMemory(name = name, create = True, size = size)
+        except FileExistsError:
+            # Only a ring marked closed, or a segment that is not a ring, is replaced.
+            # Otherwise another run is still publishing to it.
+            existing = shared_memory.SharedMemory(name = name)
+            header = np.ndarray(HEADER_FIELDS, dtype = np.int64, buffer = existing.buf) if existing.size >= HEADER_FIELDS*8 else None
+            stale = header is None or header[0] != MAGIC or bool(header[4])
+            del header
+            existing.close()
+            if not stale:
+                raise FileExistsError("Reading ring {} is in use by another run. If no run is active, it was left by a "
+                                      "killed run and can be removed with: rm /dev/shm/{}".format(name, name))
+            existing.unlink()
+            self.shm = shared_memory.SharedMemory(name = name, create = True, size = size)
+        self.name = self.shm.name
+        _created.add(self.name)
+        self._map(n_slots, len(self.columns))
+        self.shm.buf[HEADER_FIELDS*8:HEADER_FIELDS*8 + len(names)] = names
+        self.slot_seq[:] = -1
+        self.header[:] = 0
+        self.header[2] = n_slots
+        self.header[3] = len(self.columns)
+        self.header[0] = MAGIC # Written last, readers wait for it
+        self.seq = 0
+
+    def __call__(self, row):
+        self.publish(row)
+
+    def publish(self, row):
+        # Store the row in the next slot, overwriting the oldest one
+        slot = self.seq % self.n_slots
+        self.slot_seq[slot] = -1 # Marks the slot as being written
+        self.data[slot] = [np.nan if value is None else value for value in row]
+        self.slot_seq[slot] = self.seq
+        self.seq += 1
+        self.header[1] = self.seq
+
+    def close(self):
+        if self.shm is None:
+            return
+        self.header[4] = 1
+        self._release()
+        self.shm.unlink()
+        _created.discard(self.name)
+        self.shm = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class RingReader(_Ring):
+    # Consumer side. Reading starts at the oldest row still in the ring, or at the
+    # newest one with latest = True.
+    def __init__(self, name = DEFAULT_NAME, latest = False):
+        try:
+            self.shm = shared_memory.SharedMemory(name = name, track = False)
+        except TypeError: # Python < 3.13 has no track argument
+            self.shm = shared_memory.SharedMemory(name = name)
+            # Do not let the resource tracker unlink the producer's segment at exit
+            if name not in _created:
+                resource_tracker.unregister(self.shm._name, "shared_memory")
+        header = np.ndarray(HEADER_FIELDS, dtype = np.int64, buffer = self.shm.buf)
+        assert header[0] == MAGIC, "{} is not a reading ring".format(name)
+        n_slots, n_columns = int(header[2]), int(header[3])
+        del header
+        names = bytes(self.shm.buf[HEADER_FIELDS*8:HEADER_FIELDS*8 + NAMES_SIZE]).rstrip(b"\0")
+        self.columns = json.loads(names)
+        self._map(n_slots, n_columns)
+        head = int(self.header[1])
+        self.next_seq = head if latest else max(0, head - n_slots)
+        self.rows_read = 0
+        self.rows_lost = 0
+        self.overruns = 0
+
+    @property
+    def closed(self):
+        return bool(self.header[4])
+
+    def available(self):
+        return int(self.header[1]) - self.next_seq
+
+    def read(self, max_rows = None):
+        # Copy out the rows published since the last read. Returns the rows and the
+        # number of rows lost to an overrun since the last read.
+        head = int(self.header[1])
+        lost = 0
+        if head - self.next_seq > self.n_slots:
+            lost = head - self.n_slots - self.next_seq
+            self.next_seq = head - self.n_slots
+        stop = head if max_rows is None else min(head, self.next_seq + max_rows)
+        seqs = np.arange(self.next_seq, stop)
+        slots = seqs % self.n_slots
+        rows = self.data[slots] # Fancy indexing copies
+        # Slots rewritten while copying hold a later lap, these are the oldest rows read
+        valid = self.slot_seq[slots] == seqs
+        if not valid.all():
+            rows = rows[valid]
+            lost += int(len(valid) - valid.sum())
+        self.next_seq = stop
+        if lost:
+            self.overruns += 1
+            self.rows_lost += lost
+        self.rows_read += len(rows)
+        return rows, lost
+
+    def close(self):
+        if self.shm is not None:
+            self._release()
+            self.shm = None
+
+    def report(self):
+        return "Ring {}: {} rows read, {} rows lost in {} overruns".format(
+            self.shm.name if self.shm is not None else "", self.rows_read, self.rows_lost, self.overruns)
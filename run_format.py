@@ -0,0 +1,295 @@
+# ============================================================================
+# Name        : run_format.py
+# Version     : 1.0.0
+# Description : Native binary run format. A file starts with a magic string
+#               and a JSON header (column names, units, dtypes and the run
+#               parameters) followed by chunks. Every chunk stores each column
+#               as a contiguous fixed-dtype block, optionally zlib compressed.
+#               The writer merges the chunks into one when it is closed, so the
+#               reader memory-maps the file and returns every column of an
+#               uncompressed run as a NumPy view without copying it.
+# ============================================================================
+
+import json
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+import numpy as np
+import pandas as pd
+
+from run_writer import RunWriter
+
+MAGIC = b"PYRORUN1"
+CHUNK_MAGIC = b"CHNK"
+CHUNK_HEADER = struct.Struct("<4sIQI") # magic, rows, payload bytes, flags
+FLAG_ZLIB = 1
+ALIGNMENT = 8
+
+# Column order of the rows produced by the sharp_garn acquisition loop
+RUN_COLUMNS = ["current", "time", "ext_temp", "int_temp", "new_target_temp",
+               "pid_out_volt", "pelt_volt", "pelt_curr", "vsource"]
+RUN_UNITS = {"current": "A", "voltage": "V", "time": "s", "ext_temp": "degC",
+             "int_temp": "degC", "new_target_temp": "degC", "pid_out_volt": "V",
+             "pelt_volt": "V", "pelt_curr": "A", "vsource": "V"}
+
+
+def _padding(size):
+    return -size % ALIGNMENT
+
+
+class BinaryRunWriter(RunWriter):
+    # Same buffering and fsync policy as RunWriter, every flush appends one chunk.
+    # With consolidate the chunks are rewritten as a single chunk on close().
+    def __init__(self, path, columns = RUN_COLUMNS, units = None, params = None, dtype = "<f8",
+                 compress = False, flush_rows = 100, flush_interval = 5.0, fsync = "flush", consolidate = True):
+        self.columns = list(columns)
+        self.consolidate = consolidate
+        self.dtypes = [np.dtype(dtype)]*len(self.columns) if isinstance(dtype, str) else [np.dtype(d) for d in dtype]
+        self.compress = compress
+        units = units if units is not None else {c: RUN_UNITS.get(c, "") for c in self.columns}
+        self.header = {"columns": self.columns,
+                       "dtypes": [d.str for d in self.dtypes],
+                       "units": units,
+                       "params": params or {}}
+        RunWriter.__init__(self, path, flush_rows = flush_rows, flush_interval = flush_interval, fsync = fsync)
+        if self.fd.tell() == 0:
+            self.fd.write(_encode_header(self.header))
+            self.fd.flush()
+        else:
+            existing = RunReader(path).header
+            assert existing["columns"] == self.header["columns"], "Column mismatch when appending to {}".format(path)
+
+    def _recover(self):
+        # Cut the file after the last complete chunk
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return
+        with open(self.path, "rb+") as fd:
+            data = fd.read()
+            try:
+                _, position = _decode_header(data)
+            except AssertionError:
+                fd.truncate(0)
+                print("Discarded {}: incomplete header".format(self.path))
+                return
+            end = position
+            for _, _, chunk_end in _scan_chunks(data, position):
+                end = chunk_end
+            if end < len(data):
+                fd.truncate(end)
+                print("Truncated incomplete last chunk of {}".format(self.path))
+
+    def _encode(self, rows):
+        block = np.asarray(rows, dtype = float)
+        payload = bytearray()
+        for i, dtype in enumerate(self.dtypes):
+            column = np.ascontiguousarray(block[:, i], dtype = dtype).tobytes()
+            payload += column + b"\0"*_padding(len(column))
+        flags = 0
+        if self.compress:
+            payload = zlib.compress(bytes(payload))
+            flags |= FLAG_ZLIB
+        payload += b"\0"*_padding(len(payload))
+        return CHUNK_HEADER.pack(CHUNK_MAGIC, len(rows), len(payload), flags) + bytes(payload)
+
+    def close(self):
+        if self.fd.closed:
+            return
+        RunWriter.close(self)
+        if self.consolidate:
+            self._consolidate()
+
+    def _consolidate(self):
+        # Rewrite the file with one chunk holding each column contiguously. Every chunk is decoded
+        # once and its columns are spooled to temporary files, which are then joined into a file
+        # that replaces the run when complete. Memory does not grow with the run and a crash
+        # leaves the chunked file intact.
+        reader = RunReader(self.path)
+        try:
+            if len(reader.chunks) <= 1:
+                return
+            spools = [tempfile.TemporaryFile() for name in reader.columns]
+            for i in range(len(reader.chunks)):
+                chunk = reader.chunk(i)
+                for name, spool in zip(reader.columns, spools):
+                    spool.write(chunk[name].tobytes())
+                del chunk # Views into the mapped file, released before it is closed
+            temporary = self.path + ".tmp"
+            with open(temporary, "wb") as fd:
+                fd.write(_encode_header(reader.header))
+                chunk_position = fd.tell()
+                fd.write(CHUNK_HEADER.pack(CHUNK_MAGIC, 0, 0, 0)) # Sizes are known at the end
+                compressor = zlib.compressobj() if self.compress else None
+                size = 0
+                for spool in spools:
+                    spool.seek(0)
+                    for data in iter(lambda: spool.read(1 << 20), b""):
+                        data = compressor.compress(data) if compressor is not None else data
+                        fd.write(data)
+                        size += len(data)
+                    if compressor is None:
+                        fd.write(b"\0"*_padding(size))
+                        size += _padding(size)
+                    spool.close()
+                if compressor is not None:
+                    data = compressor.flush()
+                    data += b"\0"*_padding(size + len(data))
+                    fd.write(data)
+                    size += len(data)
+                fd.seek(chunk_position)
+                fd.write(CHUNK_HEADER.pack(CHUNK_MAGIC, reader.n_rows, size, FLAG_ZLIB if self.compress else 0))
+                fd.flush()
+                if self.fsync != "never":
+                    os.fsync(fd.fileno())
+        finally:
+            reader.close()
+        os.replace(temporary, self.path)
+
+
+def _encode_header(header):
+    text = json.dumps(header).encode("utf-8")
+    text += b" "*_padding(len(MAGIC) + 4 + len(text))
+    return MAGIC + struct.pack("<I", len(text)) + text
+
+
+def _decode_header(data):
+    assert len(data) >= len(MAGIC) + 4 and data[:len(MAGIC)] == MAGIC, "Not a binary run file"
+    size = struct.unpack_from("<I", data, len(MAGIC))[0]
+    start = len(MAGIC) + 4
+    assert len(data) >= start + size, "Not a binary run file"
+    return json.loads(bytes(data[start:start + size]).decode("utf-8")), start + size
+
+
+def _scan_chunks(data, position):
+    # Yield (header, payload offset, end offset) for every complete chunk
+    while position + CHUNK_HEADER.size <= len(data):
+        magic, rows, size, flags = CHUNK_HEADER.unpack_from(data, position)
+        start = position + CHUNK_HEADER.size
+        if magic != CHUNK_MAGIC or start + size > len(data):
+            return
+        yield (rows, flags), start, start + size
+        position = start + size
+
+
+class RunReader:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fd:
+            self._mmap = mmap.mmap(fd.fileno(), 0, access = mmap.ACCESS_READ)
+        self.header, position = _decode_header(self._mmap)
+        self.columns = self.header["columns"]
+        self.dtypes = [np.dtype(d) for d in self.header["dtypes"]]
+        self.units = self.header["units"]
+        self.params = self.header["params"]
+        self.chunks = [(rows, flags, start) for (rows, flags), start, _ in _scan_chunks(self._mmap, position)]
+        self.n_rows = sum(rows for rows, _, _ in self.chunks)
+
+    def __len__(self):
+        return self.n_rows
+
+    def chunk(self, i):
+        # Dictionary of column arrays, views into the mapped file when uncompressed
+        rows, flags, start = self.chunks[i]
+        if flags & FLAG_ZLIB:
+            size = CHUNK_HEADER.unpack_from(self._mmap, start - CHUNK_HEADER.size)[2]
+            buffer, offset = zlib.decompress(self._mmap[start:start + size]), 0
+        else:
+            buffer, offset = self._mmap, start
+        out = {}
+        for name, dtype in zip(self.columns, self.dtypes):
+            out[name] = np.frombuffer(buffer, dtype = dtype, count = rows, offset = offset)
+            offset += rows*dtype.itemsize + _padding(rows*dtype.itemsize)
+        return out
+
+    def _columns(self, columns):
+        # Arrays of columns, each chunk is decoded once. A single chunk is returned as views,
+        # several chunks (a file not closed yet, or written without consolidate) are concatenated.
+        parts = {name: [] for name in columns}
+        for i in range(len(self.chunks)):
+            chunk = self.chunk(i)
+            for name in columns:
+                parts[name].append(chunk[name])
+        out = {}
+        for name in columns:
+            if len(parts[name]) == 1:
+                out[name] = parts[name][0]
+            elif not parts[name]:
+                out[name] = np.empty(0, dtype = self.dtypes[self.columns.index(name)])
+            else:
+                out[name] = np.concatenate(parts[name])
+        return out
+
+    def column(self, name):
+        return self._columns([name])[name]
+
+    def to_frame(self, columns = None):
+        return pd.DataFrame(self._columns(columns or self.columns), copy = False)
+
+    def rows(self, start = 0, stop = None, columns = None):
+        # DataFrame of the rows start ... stop-1, only the chunks holding them are read
+        columns = columns or self.columns
+        stop = self.n_rows if stop is None else min(stop, self.n_rows)
+        parts = {name: [] for name in columns}
+        first_row = 0
+        for i, (rows, _, _) in enumerate(self.chunks):
+            if first_row < stop and first_row + rows > start:
+                chunk = self.chunk(i)
+                for name in columns:
+                    parts[name].append(chunk[name][max(start - first_row, 0):stop - first_row])
+            first_row += rows
+        data = {name: np.concatenate(parts[name]) if parts[name] else np.empty(0, dtype = self.dtypes[self.columns.index(name)])
+                for name in columns}
+        return pd.DataFrame(data, index = pd.RangeIndex(start, max(start, stop)), copy = False)
+
+    def time_range(self, start_time, stop_time, columns = None, time_column = "time"):
+        # Rows with start_time <= time <= stop_time, the time column must be increasing
+        time = self.column(time_column)
+        start = np.searchsorted(time, start_time, side = "left")
+        stop = np.searchsorted(time, stop_time, side = "right")
+        return self.rows(start, stop, columns)
+
+    def close(self):
+        self._mmap.close()
+
+
+def iter_run(file_name, columns = RUN_COLUMNS, chunk_rows = 100000, usecols = None):
+    # DataFrames of up to chunk_rows consecutive rows of a recorded run, so a run never
+    # has to fit in memory
+    if file_name.endswith(".run"):
+        reader = RunReader(file_name)
+        try:
+            for i in range(len(reader.chunks)):
+                for start in range(0, reader.chunks[i][0], chunk_rows):
+                    chunk = reader.chunk(i)
+                    df = pd.DataFrame({name: np.array(chunk[name][start:start + chunk_rows]) for name in (usecols or reader.columns)})
+                    del chunk # Views into the mapped file, released before it is closed
+                    yield df
+        finally:
+            reader.close()
+    else:
+        yield from pd.read_csv(file_name, names = columns, usecols = usecols, chunksize = chunk_rows)
+
+
+def run_extent(file_name, columns = RUN_COLUMNS, chunk_rows = 100000, time_column = "time"):
+    # Number of rows and last time of a recorded run, CSV files are read column by column in chunks
+    if file_name.endswith(".run"):
+        reader = RunReader(file_name)
+        try:
+            last_time = float(reader.chunk(len(reader.chunks) - 1)[time_column][-1]) if reader.chunks else None
+            return reader.n_rows, last_time
+        finally:
+            reader.close()
+    n_rows, last_time = 0, None
+    for chunk in iter_run(file_name, columns, chunk_rows, usecols = [time_column]):
+        if len(chunk):
+            n_rows += len(chunk)
+            last_time = chunk[time_column].iloc[-1]
+    return n_rows, last_time
+
+
+def load_run(file_name, columns = RUN_COLUMNS):
+    # Load a recorded run, binary (.run) or header-less CSV, into a DataFrame
+    if file_name.endswith(".run"):
+        return RunReader(file_name).to_frame()
+    return pd.read_csv(file_name, names = columns)
@@ -0,0 +1,108 @@
+# ============================================================================
+# Name        : run_writer.py
+# Version     : 1.0.0
+# Description : Keeps the run file open during the whole measurement, buffers
+#               the rows in memory and writes them in batches. A flush is
+#               triggered by a row count or a time interval, and every flush
+#               writes whole lines only, so after a crash the file ends on the
+#               last completed flush.
+# ============================================================================
+
+import csv
+import io
+import os
+import time
+
+
+class RunWriter:
+    # fsync: "flush" syncs to disk after every flush, "close" only when the
+    # file is closed and "never" leaves it to the operating system.
+    def __init__(self, path, flush_rows = 100, flush_interval = 5.0, fsync = "flush"):
+        assert fsync in ("flush", "close", "never"), "Unknown fsync policy: {}".format(fsync)
+        self.path = path
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.rows_written = 0
+        self.flush_count = 0
+        self.flush_time = 0 # Total time spent flushing in seconds
+        self.flush_time_max = 0
+        self.last_flush_time = 0
+        self._rows = []
+        self._last_flush = time.time()
+        self._recover()
+        self.fd = open(self.path, "ab")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _recover(self):
+        # Drop a partially written last line left behind by an interrupted flush
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb+") as fd:
+            size = fd.seek(0, os.SEEK_END)
+            if size == 0:
+                return
+            fd.seek(size - 1)
+            if fd.read(1) == b"\n":
+                return
+            position = size
+            while position > 0:
+                step = min(4096, position)
+                position -= step
+                fd.seek(position)
+                end = fd.read(step).rfind(b"\n")
+                if end != -1:
+                    fd.truncate(position + end + 1)
+                    print("Truncated incomplete last line of {}".format(self.path))
+                    return
+            fd.truncate(0)
+
+    def _encode(self, rows):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        return buffer.getvalue().encode("ascii")
+
+    def write_row(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= self.flush_rows or time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def write_rows(self, rows):
+        self._rows.extend(rows)
+        if len(self._rows) >= self.flush_rows or time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.time()
+        if not self._rows:
+            return
+        start = time.perf_counter()
+        self.fd.write(self._encode(self._rows))
+        self.fd.flush()
+        if self.fsync == "flush":
+            os.fsync(self.fd.fileno())
+        self.rows_written += len(self._rows)
+        self._rows = []
+        self.last_flush_time = time.perf_counter() - start
+        self.flush_time += self.last_flush_time
+        self.flush_time_max = max(self.flush_time_max, self.last_flush_time)
+        self.flush_count += 1
+
+    def close(self):
+        if self.fd.closed:
+            return
+        self.flush()
+        if self.fsync != "never":
+            os.fsync(self.fd.fileno())
+        self.fd.close()
+
+    def report(self):
+        mean = self.flush_time/self.flush_count if self.flush_count else 0
+        return "Wrote {} rows in {} flushes, flush latency mean: {} ms  max: {} ms  total: {} s".format(
+            self.rows_written, self.flush_count, round(mean*1000, 3),
+            round(self.flush_time_max*1000, 3), round(self.flush_time, 3))
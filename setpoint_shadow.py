@@ -0,0 +1,47 @@
+# ============================================================================
+# Name        : setpoint_shadow.py
+# Version     : 1.0.0
+# Description : Remembers the last setpoint written to an instrument, quantized
+#               to the resolution of the device, and skips writes that would
+#               not change anything on the device.
+# ============================================================================
+
+import math
+
+
+class SetpointShadow:
+    def __init__(self, name):
+        self.name = name
+        self.values = {} # Last value applied per setpoint
+        self.writes = 0
+        self.writes_saved = 0
+
+    def quantize(self, value, resolution = None):
+        if resolution is None:
+            return value
+        digits = max(0, -math.floor(math.log10(resolution)))
+        return round(round(float(value)/resolution)*resolution, digits)
+
+    def apply(self, key, value, write, resolution = None):
+        # Call write with the quantized value unless it is already applied. A write
+        # returning False failed, the value on the device is then unknown.
+        value = self.quantize(value, resolution)
+        if key in self.values and self.values[key] == value:
+            self.writes_saved += 1
+            return False
+        if write(value) is False:
+            self.values.pop(key, None)
+            return False
+        self.values[key] = value
+        self.writes += 1
+        return True
+
+    def invalidate(self, key = None):
+        # Forget the applied values, e.g. after a reset of the device
+        if key is None:
+            self.values.clear()
+        else:
+            self.values.pop(key, None)
+
+    def report(self):
+        return "{}: {} setpoint writes, {} redundant writes skipped".format(self.name, self.writes, self.writes_saved)
@@ -11,6 +11,7 @@
 
 import sys
 import time
+import queue
 import os
 import numpy as np
 import pandas as pd
@@ -25,6 +26,101 @@ from data_postprocessing import analyze
 from keithley6517_commands import KEITHLEY6517
 from coldplate_commands import COLDPLATE
 from cpx400sp import CPX400SP
+from instrument_pollers import start_pollers, stop_pollers
+from keithley_burst import BurstAcquisition
+from run_writer import RunWriter
+from control_loop import ControlLoop
+from instrumentation import Instrumentation
+from run_format import BinaryRunWriter, RUN_COLUMNS, load_run
+from analysis_io import save_analysis, export_excel
+from plot_pyramid import save_pyramid
+from reading_ring import ReadingRing
+from live_analysis import IncrementalAnalyzer
+from lockin import LockInAnalyzer
+from analysis_cache import AnalysisCache
+
+
+def sine(tdelta, frequency, amplitude, slope, offset):
+    return amplitude * np.sin(2*np.pi*frequency*tdelta) + slope*tdelta + offset
+
+
+def acquisition_loop(k, cp, cpx, writer, pid, loop_time, temp_freq, temp_ampl, temp_slope, temp_offset,
+                     temp_margin = 5, peltier_status = "active", pelt_limit_voltage = 5, control_period = 0.1,
+                     acquisition_mode = "single", burst_block_size = 100, burst_interval = 0.05,
+                     peripheral_period = 0.5, reading_timeout = 5, timing = None, consumers = (), verbose = True):
+    # Record readings for loop_time seconds while the PID and the coldplate follow the
+    # temperature function. Every recorded row is also passed to each of the consumers.
+    timing = timing if timing is not None else Instrumentation(enabled = False)
+    start_time = time.time()
+    pelt_voltage = 0
+    new_target_temp = temp_offset
+
+    # Each instrument is polled by its own worker, the Keithley readings pace the loop
+    if acquisition_mode == "burst":
+        pollers = start_pollers(k, cp, cpx, peripheral_period, keithley_poller = BurstAcquisition,
+                                block_size = burst_block_size, interval = burst_interval)
+    else:
+        pollers = start_pollers(k, cp, cpx, peripheral_period)
+    cache, k_poller, cpx_poller, cp_poller = pollers
+    # The peltier PID runs at its own fixed rate on the latest external temperature
+    control = ControlLoop(pid, cache,
+                          setpoint = lambda tdelta: sine(tdelta,
+                                                         frequency = temp_freq,
+                                                         amplitude = temp_ampl,
+                                                         slope = temp_slope,
+                                                         offset = temp_offset),
+                          output = lambda voltage: cpx_poller.command("voltage", cpx.set_voltage, voltage),
+                          period = control_period,
+                          limit = pelt_limit_voltage)
+    timing.wrap(control, "PID", ["step"])
+    control.start()
+    while time.time() - start_time <= loop_time:
+        timing.start_iteration()
+        # Measure and save
+        try:
+            reading = k_poller.next_reading(timeout = reading_timeout)
+        except queue.Empty:
+            print("No reading from the electrometer for {} s".format(reading_timeout))
+            continue # Re-check the loop time
+        timing.mark("keithley_wait")
+        tdelta = reading[1]
+        pelt_voltage = cache.get("pid_out_volt", pelt_voltage)
+        new_target_temp = cache.get("new_target_temp", new_target_temp)
+        reading.insert(3, cache.get("pelt_curr"))
+        reading.insert(3, cache.get("pelt_volt"))
+        reading.insert(3, round(pelt_voltage, 3))
+        reading.insert(3, round(new_target_temp, 3))
+        reading.insert(3, cache.get("int_temp"))
+        # data.append(reading)
+        if verbose:
+            print(reading)
+        timing.mark("assemble")
+
+
+
+        # Set new coldplate target temperature
+        if peltier_status == "active":
+            cp_temp_freq = 0
+            cp_temp_ampl = 0
+        else:
+            cp_temp_freq = temp_freq
+            cp_temp_ampl = temp_ampl
+
+        cp_poller.command("target", cp.set_tempTarget, sine(tdelta,
+                                                             frequency = cp_temp_freq,
+                                                             amplitude = cp_temp_ampl,
+                                                             slope = temp_slope,
+                                                             offset = temp_offset-temp_margin))
+        timing.mark("setpoints")
+        writer.write_row(reading)
+        timing.mark("file_output")
+        for consumer in consumers:
+            consumer(reading)
+        timing.mark("consumers")
+        timing.end_iteration()
+    control.stop()
+    stop_pollers(k_poller, cpx_poller, cp_poller)
+    return control
 
 
 def main():
@@ -44,11 +140,25 @@ def main():
     current_range = 200E-9 # Upper current range limit.
     nplcycles = 1 # Integration period based on power line frequency (0.01-10)
     average_window = 0 # Average filter window
+    data_format = "ascii" # Reading transfer format: "ascii", "sreal" (4-byte binary) or "dreal" (8-byte binary)
+    acquisition_mode = "single" # "single" (one read? per sample) or "burst" (instrument-paced buffer blocks)
+    burst_block_size = 100 # Readings per buffer block in burst mode
+    burst_interval = 0.05 # Sample interval of the trigger timer in burst mode, in seconds
     # Peltier cell
     peltier_status = "active"
     pelt_limit_voltage = 5
     pelt_limit_current = 4
     P, I, D = (0.6, 0.03, 0.05) #Good PID values are 0.6, 0.03, 0.05
+    control_period = 0.1 # Fixed PID update period in seconds, independent of the sampling rate
+    # Data output
+    output_format = "csv" # "csv" or "binary" (chunked columnar .run file)
+    compress_output = False # zlib compression of the binary chunks
+    analysis_format = "parquet" # Analyzed data: "parquet", "feather", "run" or "csv"
+    excel_export = False # Also convert the analyzed data to .xlsx after the run
+    instrument_timing = False # Record per-call latencies and a per-iteration breakdown next to the run data
+    reading_ring = True # Publish the rows to shared memory for live_viewer.py and other local consumers
+    live_analysis = True # Analyze each window during the run and append it to the _LIVE.csv side file
+    live_lockin = True # Lock-in demodulation during the run, written to the _LOCKIN.csv side file
     # *********************************************************************************
 
     #assetions
@@ -58,62 +168,59 @@ def main():
     cp = COLDPLATE("/dev/ttyUSB1")
     k = KEITHLEY6517("ASRL/dev/ttyUSB2::INSTR", baud_rate = 19200, sleep = 0.05)
     cpx = CPX400SP('192.168.1.131', 9221)
+    timing = Instrumentation(enabled = instrument_timing)
+    timing.instrument_devices(k, cp, cpx)
 
     # Functions
     def setup_keithley(current_range, nplcycles, average_window):
-        # Reset device to defaults
-        k.reset()
-        k.clear_reg()
-        k.status_queue_next("Reset")
-
-        # Select sensing function
-        k.sense_function("'current'")
-        k.status_queue_next("Sensing function")
-
-        # Zero correct
-        k.current_range(20E-12)
-        k.system_zcorrect("ON")
-        k.status_queue_next("Zero correct")
-
-        # Select measurement range of interest
-        k.current_range(current_range)
-        k.system_zcheck("OFF")
-        k.status_queue_next("Current range")
-
-        # Integration time
-        k.current_nplcycles(nplcycles)
-        k.system_pwrlinesync("OFF")
-        k.status_queue_next("Integration time")
-
-        # Timestamp
-        k.system_tstamp_type("relative")
-        k.system_tstamp_relative_reset()
-        k.system_tstamp_format("absolute")
-        k.status_queue_next("Timestamp")
-
-        # Median filter
-        k.current_median_state("ON")
-        k.current_median_rank(1)
-        k.status_queue_next("Median filter")
-
-        # Average filter
-        if average_window != 0:
-            k.current_average_state("OFF")
-            k.current_average_type("scalar")
-            k.current_average_tcontrol("repeat")
-            k.current_average_count(average_window)
-            k.status_queue_next("Average filter")
-
-        # External temperature
-        k.system_tscontrol("ON")
-        k.status_queue_next("External temperature")
-
-        # Data format
-        k.format_elements(elements = "tstamp, reading, vsource, etemperature")
-        k.status_queue_next("Data format")
-
         # Timeout
         k.pyvisa_timeout(10000) # In milliseconds
+
+        # The whole setup is sent as a few joined messages, errors are checked once at the end
+        with k.batch("Keithley setup"):
+            # Reset device to defaults
+            k.reset()
+            k.clear_reg()
+
+            # Select sensing function
+            k.sense_function("'current'")
+
+            # Zero correct
+            k.current_range(20E-12)
+            k.system_zcorrect("ON")
+
+            # Select measurement range of interest
+            k.current_range(current_range)
+            k.system_zcheck("OFF")
+
+            # Integration time
+            k.current_nplcycles(nplcycles)
+            k.system_pwrlinesync("OFF")
+
+            # Timestamp
+            k.system_tstamp_type("relative")
+            k.system_tstamp_relative_reset()
+            k.system_tstamp_format("absolute")
+
+            # Median filter
+            k.current_median_state("ON")
+            k.current_median_rank(1)
+
+            # Average filter
+            if average_window != 0:
+                k.current_average_state("OFF")
+                k.current_average_type("scalar")
+                k.current_average_tcontrol("repeat")
+                k.current_average_count(average_window)
+
+            # External temperature
+            k.system_tscontrol("ON")
+
+            # Data format
+            k.format_elements(elements = "tstamp, reading, vsource, etemperature")
+            k.format_data(data_format)
+            if data_format != "ascii":
+                k.format_border("swapped") # Little endian, decoded without byte swapping
     def counter(seconds, message, delay = 1):
         start_time = time.time()
         while time.time() - start_time <= seconds:
@@ -121,8 +228,6 @@ def main():
             time_left = round(seconds-tdelta, 1)
             print("Time left: {}, {}".format(time_left, message))
             time.sleep(delay)
-    def sine(tdelta, frequency, amplitude, slope, offset):
-        return amplitude * np.sin(2*np.pi*frequency*tdelta) + slope*tdelta + offset
     def v_function(tdelta, function, frequency, amplitude, slope, offset):
         if function  == "sine":
             applied_funct_voltage = sine(tdelta, frequency, amplitude,  slope, offset)
@@ -143,6 +248,7 @@ def main():
                                                loop_time,
                                                sample_identification)
     file_name = new_datefolder("../data") + name
+    run_columns = RUN_COLUMNS
     
     # Setup peltier element
     print("Setting up peltier element...")
@@ -168,8 +274,13 @@ def main():
     print("Wait until starting temperature is reached...")
     past_time = 0
     setup_data = []
+    cache, k_poller, cpx_poller, cp_poller = start_pollers(k, cp, cpx)
     while past_time < setup_time:
-        reading = k.read_latest()
+        try:
+            reading = k_poller.next_reading(timeout = 5)
+        except queue.Empty:
+            print("No reading from the electrometer for 5 s")
+            continue
         past_time = reading[1]
         ext_temp = reading[2]
         if past_time > setup_time/2:
@@ -177,14 +288,16 @@ def main():
             pelt_voltage = pid(ext_temp)
             if pelt_voltage > pelt_limit_voltage:
                 pelt_voltage = pelt_limit_voltage
-            cpx.set_voltage(pelt_voltage)
-        reading.insert(3, float(cpx.get_current()[:-2]))
-        reading.insert(3, float(cpx.get_voltage()[:-2]))
+            cpx_poller.command("voltage", cpx.set_voltage, pelt_voltage)
+        reading.insert(3, cache.get("pelt_curr"))
+        reading.insert(3, cache.get("pelt_volt"))
         reading.insert(3, round(pelt_voltage, 3))
         reading.insert(3, round(new_target_temp,  3))
-        reading.insert(3, round(cp.get_tempActual(), 3))
+        reading.insert(3, cache.get("int_temp"))
         setup_data.append(reading)
         print("Setting up...   ", reading)
+    # Pollers are restarted after the timestamp reset so no stale reading leaks into the run
+    stop_pollers(k_poller, cpx_poller, cp_poller)
         
     setup_data_df = pd.DataFrame(setup_data)
     plt.scatter(setup_data_df.iloc[:,1], setup_data_df.iloc[:,2])
@@ -198,68 +311,69 @@ def main():
     k.system_tstamp_relative_reset()
     print("Finished setup, ready to start measurement.")
 
-    # Set variables
-    start_time = time.time()
-    subset = []
-    data = []
-
-    # tdelta = k.read_latest()[1]
-    pelt_voltage = 0
-
     # Loop
-    while time.time() - start_time <= loop_time:
-        # Measure and save
-        reading = k.read_latest()
-        tdelta = reading[1]
-        reading.insert(3, float(cpx.get_current()[:-2]))
-        reading.insert(3, float(cpx.get_voltage()[:-2]))
-        reading.insert(3, round(pelt_voltage, 3))
-        reading.insert(3, round(new_target_temp, 3))
-        reading.insert(3, round(cp.get_tempActual(), 3))
-        # data.append(reading)
-        print(reading)
-
-
-
-        # Set new target temperature
-        new_target_temp = sine(tdelta,
-                               frequency = temp_freq,
-                               amplitude = temp_ampl,
-                               slope = temp_slope,
-                               offset = temp_offset)
-        pid.setpoint = new_target_temp
-        pelt_voltage = pid(reading[2])
-        # To avoid damaging the peltier element
-        if pelt_voltage > pelt_limit_voltage:
-            pelt_voltage = pelt_limit_voltage
-        cpx.set_voltage(pelt_voltage)
-        if peltier_status == "active":
-            cp_temp_freq = 0
-            cp_temp_ampl = 0
-        else:
-            cp_temp_freq = temp_freq
-            cp_temp_ampl = temp_ampl
-
-        cp.set_tempTarget(sine(tdelta,
-                               frequency = cp_temp_freq,
-                               amplitude = cp_temp_ampl,
-                               slope = temp_slope,
-                               offset = temp_offset-temp_margin))
-        with open('{}.csv'.format(file_name), 'a') as fd:
-            writer = csv.writer(fd)
-            writer.writerow(reading)
+    if output_format == "binary":
+        run_file = '{}.run'.format(file_name)
+        writer = BinaryRunWriter(run_file, columns = run_columns, compress = compress_output,
+                                 params = {"sample_identification": sample_identification,
+                                           "loop_time": loop_time,
+                                           "electrode_area": electrode_area,
+                                           "temp_ampl": temp_ampl,
+                                           "temp_freq": temp_freq,
+                                           "temp_slope": temp_slope,
+                                           "temp_offset": temp_offset,
+                                           "current_range": current_range,
+                                           "nplcycles": nplcycles,
+                                           "average_window": average_window,
+                                           "peltier_status": peltier_status,
+                                           "PID": [P, I, D]},
+                                 flush_rows = 100, flush_interval = 5, fsync = "flush")
+    else:
+        run_file = '{}.csv'.format(file_name)
+        writer = RunWriter(run_file, flush_rows = 100, flush_interval = 5, fsync = "flush")
+    timing.open_iterations('{}_TIMING.csv'.format(file_name))
+    consumers = []
+    if reading_ring:
+        try:
+            ring = ReadingRing(run_columns)
+            consumers.append(ring)
+        except Exception as e:
+            print("Recording without the reading ring: {}".format(e))
+            reading_ring = False
+    if live_analysis:
+        live = IncrementalAnalyzer('{}_LIVE.csv'.format(file_name), electrode_area = electrode_area,
+                                   points_p_period = 10, freq = 0.01, window = 51, engine = "linear")
+        consumers.append(live)
+    if live_lockin:
+        lockin = LockInAnalyzer('{}_LOCKIN.csv'.format(file_name), electrode_area = electrode_area, freq = temp_freq)
+        consumers.append(lockin)
+    control = acquisition_loop(k, cp, cpx, writer, pid,
+                               loop_time = loop_time,
+                               temp_freq = temp_freq,
+                               temp_ampl = temp_ampl,
+                               temp_slope = temp_slope,
+                               temp_offset = temp_offset,
+                               temp_margin = temp_margin,
+                               peltier_status = peltier_status,
+                               pelt_limit_voltage = pelt_limit_voltage,
+                               control_period = control_period,
+                               acquisition_mode = acquisition_mode,
+                               burst_block_size = burst_block_size,
+                               burst_interval = burst_interval,
+                               timing = timing,
+                               consumers = consumers)
+    writer.close()
+    if live_analysis:
+        live.close()
+    if live_lockin:
+        lockin.close()
+    if reading_ring:
+        ring.close()
+    timing.close('{}_TIMING.txt'.format(file_name))
 
     
     # Save the data
-    df = pd.read_csv('{}.csv'.format(file_name), names = ["current",
-                                       "time",
-                                       "ext_temp",
-                                       "int_temp",
-                                       "new_target_temp",
-                                       "pid_out_volt",
-                                       "pelt_volt",
-                                       "pelt_curr",
-                                       "vsource"])
+    df = load_run(run_file, columns = run_columns)
     df = df[["time",
              "current",
              "int_temp",
@@ -272,14 +386,28 @@ def main():
     #df = df.rolling(window = 5, min_periods = 5, axis = 0).mean()
 #     df.to_csv('{}.csv'.format(file_name), header=False, index=False)
     #df.to_excel('{}.xlsx'.format(file_name))
-    analyzed_data, figure = analyze(df = df, electrode_area = electrode_area, points_p_period = 10, freq = 0.01, window = 51)
-    analyzed_data.to_excel('{}.xlsx'.format(file_name + "ANALYZED"))
+    analyzed_data, figure = analyze(df = df, electrode_area = electrode_area, points_p_period = 10, freq = 0.01, window = 51, engine = "linear", phase_method = "batched", decimation = "resample",
+                                    cache = AnalysisCache("../data/.analysis_cache"))
+    analysis_file = save_analysis(analyzed_data, file_name + "ANALYZED", analysis_format)
+    if excel_export:
+        export_excel(analysis_file)
+    save_pyramid(df, run_file) # For plotting the run and its analysis at any zoom
+    save_pyramid(analyzed_data, analysis_file)
     figure.savefig('{}.png'.format(file_name + "ANALYZED"))
 
 
     # Print statistics
     print("######################################################################")
-    reading_period(df, "time")
+    if not instrument_timing: # Otherwise the loop.iteration line of the timing summary holds the sampling period
+        reading_period(df, "time")
+    print(writer.report())
+    print(control.report())
+    if live_analysis:
+        print(live.report())
+    if live_lockin:
+        print(lockin.report())
+    for device in (k, cp, cpx):
+        print(device.shadow.report())
     print("Measured current mean: {}    std: {}".format(df.current.mean(), df.current.std()))
     print("######################################################################")
     print("File name: " + file_name)
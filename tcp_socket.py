@@ -12,6 +12,7 @@ import socket
 class TCP_Socket:
     def __init__(self, ip, port):
         # Opens up a socket connection to the instrument
+        self.buffer = bytearray() # Received bytes not yet returned by receive
         try:
             self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.s.connect((ip, port))
@@ -27,26 +28,29 @@ class TCP_Socket:
             print('Desctructor called, TCP_Socket could not been deleted.')
 
     def send(self, command):
-        # Send command
+        # Send command, returns False if it could not be sent
         try:
             command += '\n'
             command = command.encode('ascii')
             self.s.sendall(command)
+            return True
         except:
             print('Sending data to device failed.')
+            return False
 
     def receive(self):
-        # Read data until newline character
-        data = " "
+        # Read data until newline character. Bytes received after the newline
+        # stay in the buffer and start the next response.
         while True:
-            message = self.s.recv(1024)
-            message = message.decode('ascii')
-            last = len(message)
-            if message[last-1] == '\n':
-                data = data + message[:-1]
-                return data
-            else:
-                data = data + message
+            end = self.buffer.find(b'\n')
+            if end != -1:
+                line = self.buffer[:end].decode('ascii')
+                del self.buffer[:end + 1]
+                return line
+            message = self.s.recv(4096)
+            if not message:
+                raise ConnectionError('Connection closed by device.')
+            self.buffer += message
 
     def ask(self, command):
         # Return value from query
@@ -57,3 +61,13 @@ class TCP_Socket:
         except: 
             print('Asking device for return value failed.')
 
+    def ask_many(self, commands):
+        # Pipelined queries: send all commands at once and match the answers in order.
+        # Failures are raised, the caller cannot unpack a partial answer.
+        try:
+            self.s.sendall(''.join(command + '\n' for command in commands).encode('ascii'))
+            return [self.receive() for _ in commands]
+        except:
+            self.buffer.clear() # Do not match stale answers to the next queries
+            print('Asking device for return values failed.')
+            raise